@@ -0,0 +1,68 @@
+import com.google.googlejavaformat.java.Formatter;
+import com.google.googlejavaformat.java.FormatterException;
+import com.google.googlejavaformat.java.StringWrapper;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.IOException;
+import java.nio.charset.StandardCharsets;
+
+/*
+    Keeps google-java-format resident so sources can be formatted without a
+    JVM start per batch. Run from java_formatter.py with google-format.jar on
+    the classpath.
+
+    Requests are a 4 byte big endian length then that many bytes of UTF-8
+    source. Responses are a 4 byte status (0 formatted, 1 could not be
+    formatted and returned unchanged), a 4 byte length and the source.
+
+    Does the same as java -jar google-format.jar --skip-sorting-imports
+    --skip-removing-unused-imports. StringWrapper needs google-java-format
+    1.8 or later; with an older jar this won't compile and java_formatter
+    goes back to running the jar once per file.
+*/
+public class FormatServer {
+    public static void main(String[] args) throws IOException {
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        DataOutputStream out = new DataOutputStream(new BufferedOutputStream(System.out));
+        Formatter formatter = new Formatter();
+
+        while (true) {
+            int length;
+            try {
+                length = in.readInt();
+            } catch (EOFException e) {
+                break;
+            }
+
+            byte[] source = new byte[length];
+            in.readFully(source);
+
+            int status = 0;
+            byte[] result;
+            try {
+                String formatted = formatter.formatSource(new String(source, StandardCharsets.UTF_8));
+                formatted = StringWrapper.wrap(Formatter.MAX_LINE_LENGTH, formatted, formatter);
+                result = formatted.getBytes(StandardCharsets.UTF_8);
+            } catch (FormatterException e) {
+                System.err.println(e.getMessage());
+                status = 1;
+                result = source;
+            } catch (Throwable e) {
+                // Whatever else goes wrong only loses this one source, as it
+                // would with a JVM per file, rather than the whole server
+                System.err.println(e);
+                status = 1;
+                result = source;
+            }
+
+            out.writeInt(status);
+            out.writeInt(result.length);
+            out.write(result);
+            out.flush();
+        }
+    }
+}
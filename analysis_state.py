@@ -0,0 +1,115 @@
+import hashlib
+import os
+import pickle
+import uuid
+
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from diag_utils import DiagnosticsDiff, LineageIndex
+
+# Shared by every tool run from the same working directory, like dump/
+CACHE_DIR = Path("cache") / "analysis"
+# Bumped whenever LineageIndex changes what it pickles
+LINEAGE_VERSION = 2
+
+
+def state_folder(folder: Path) -> Path:
+    "Where what is known about folder is kept, the same however folder was named"
+    resolved = str(folder.resolve()).encode("utf-8")
+    return CACHE_DIR / (hashlib.sha1(resolved).hexdigest()[:16] + "-" + folder.name)
+
+
+def _load(path: Path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, AttributeError, pickle.UnpicklingError):
+        return None
+
+
+def _save(path: Path, obj):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp.replace(path)
+
+
+class AnalysisState:
+    """
+    What an analysis of a comparison folder worked out the last time it ran,
+    so a rerun only does the work for files that are new or have changed.
+
+    Files are told apart by their mtime and size, as in the folder's
+    .diff_index. The LineageIndex over the folder's diffs is shared by every
+    analysis and extended with diffs appended since it was saved, while each
+    analysis keeps its own results keyed by the files they were worked out from.
+    """
+
+    def __init__(self, folder: Path, analysis: str):
+        self.folder = folder
+        self._folder = state_folder(folder)
+        self._path = self._folder / (analysis + ".pickle")
+        self._stats: Dict[str, Tuple[int, int]] = {}
+        self._results = _load(self._path) or {}
+        self._used = {}
+        self.generation = None
+        self.reused = 0
+        self.computed = 0
+
+    def stat(self, file: Path) -> Tuple[int, int]:
+        key = str(file)
+        if key not in self._stats:
+            stat = os.stat(file)
+            self._stats[key] = (stat.st_mtime_ns, stat.st_size)
+
+        return self._stats[key]
+
+    def fingerprint(self, files: Iterable[Path]) -> tuple:
+        return tuple((file.name, *self.stat(file)) for file in files)
+
+    def memo(self, key, inputs: Iterable[Path], compute: Callable):
+        "compute(), or what it returned last run if none of inputs have changed since"
+        fingerprint = self.fingerprint(inputs)
+        entry = self._results.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            self.reused += 1
+        else:
+            entry = (fingerprint, compute())
+            self.computed += 1
+
+        self._used[key] = entry
+        return entry[1]
+
+    def lineage(self, diffs: List[DiagnosticsDiff]) -> LineageIndex:
+        """
+        A LineageIndex over diffs, only appending those added since it was
+        last saved. Any other change rebuilds it and starts a new generation,
+        as track numbers from the old one no longer mean anything.
+        """
+        path = self._folder / "lineage.pickle"
+        fingerprint = self.fingerprint(diff.file for diff in diffs)
+
+        saved = _load(path)
+        if saved is not None and saved[0] == LINEAGE_VERSION and fingerprint[:len(saved[2])] == saved[2]:
+            (_, self.generation, saved_fingerprint, lineage) = saved
+            # The saved diffs are stand ins that reread their files, use the loaded ones
+            lineage.diffs[:] = diffs[:len(lineage)]
+        else:
+            (self.generation, saved_fingerprint, lineage) = (uuid.uuid4().hex, None, LineageIndex())
+
+        for diff in diffs[len(lineage):]:
+            lineage.append(diff)
+
+        if saved_fingerprint != fingerprint:
+            _save(path, (LINEAGE_VERSION, self.generation, fingerprint, lineage))
+
+        return lineage
+
+    def save(self):
+        "Keeps only the results used this run, so those of files since removed drop out"
+        _save(self._path, self._used)
+
+    def __str__(self):
+        return f"{self.reused} results reused, {self.computed} worked out"
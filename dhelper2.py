@@ -4,6 +4,8 @@ import githelpers
 import shutil
 import re
 import os
+import itertools
+import multiprocessing
 
 from diag_utils import DiagnosticsFile, Diagnostic
 from pathlib import Path
@@ -28,34 +30,38 @@ def get_granularity(file: Path):
         return "0"
 
 
-def stitch_together(project, output, folders):
-    files = [file for folder in folders
-             for file in folder.glob("*")
-             if file.is_file() and not file.name.endswith(".skip")]
-
-    all_commits = githelpers.get_all_commits(project)
+def link_or_copy(src: Path, dst: Path):
+    "Hardlinks src to dst, copying where links aren't possible, replacing dst atomically"
+    tmp = dst.with_name(dst.name + f".{os.getpid()}.tmp")
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
 
-    def get_commit_index(file: Path):
-        return all_commits.index(get_commit(file))
 
-    sorted_files = sorted(files, key=get_commit_index)
+def list_diagnostics_files(folder: Path):
+    return (Path(entry.path) for entry in os.scandir(folder)
+            if entry.is_file() and not entry.name.endswith(".skip"))
 
-    commit_grains = {get_commit(file): [] for file in sorted_files}
-    for file in sorted_files:
-        commit_grains[get_commit(file)].append(get_granularity(file))
 
-    processed = set([])
-    seq = 0
-    for file in sorted_files:
-        commit = get_commit(file)
-        if commit in processed:
-            continue
+def stitch_together(project, output, folders):
+    commit_index = githelpers.get_commit_index(project)
 
-        shutil.copy(file, output /
-                    f"{seq} {commit}.{'-'.join(commit_grains[commit])}")
+    # The first file seen for a commit is the one kept, the others only add their grains
+    commit_files = {}
+    commit_grains = {}
+    for folder in folders:
+        for file in list_diagnostics_files(folder):
+            commit = get_commit(file)
+            if commit not in commit_files:
+                commit_files[commit] = file
+                commit_grains[commit] = []
+            commit_grains[commit].append(get_granularity(file))
 
-        seq += 1
-        processed.add(commit)
+    for (seq, commit) in enumerate(sorted(commit_files, key=commit_index.position)):
+        link_or_copy(commit_files[commit],
+                     output / f"{seq} {commit}.{'-'.join(commit_grains[commit])}")
 
 
 def weird(folder1: Path, folder2: Path):
@@ -77,35 +83,39 @@ def weird(folder1: Path, folder2: Path):
             print(commit, len(diags[0].diagnostics), len(diags[1].diagnostics))
 
 
-def consensus(folders):
-    files = [file for folder in folders
-             for file in DiagnosticsFile.load_all(folder)]
+def read_count(file: Path) -> int:
+    "The number of diagnostics in file, read from its header"
+    with open(file) as f:
+        return int(f.readline().split(" ")[1])
 
-    # Group by commit
+
+def consensus(folders):
+    # Group by commit, only ever reading the first line of each file
     commits = {}
-    for file in files:
-        if file.commit not in commits.keys():
-            commits[file.commit] = []
-        commits[file.commit].append(file)
+    for folder in folders:
+        for file in list_diagnostics_files(folder):
+            (_, commit) = file.with_suffix('').stem.split(" ")
+            commits.setdefault(commit, []).append((read_count(file), file))
 
     # For any tie copy largest file
-    for (_, files) in commits.items():
+    for files in commits.values():
         if len(files) <= 1:
             continue
 
         # Do all files agree?
-        if len(set((len(file.diagnostics) for file in files))) == 1:
+        if len(set(count for (count, _) in files)) == 1:
             continue
 
-        most_diags = sorted(files, key=lambda file: len(file.diagnostics))[-1]
-        for diag_file in files:
-            if most_diags.file == diag_file.file:
+        # The last of the largest, as a stable sort by count would give
+        (_, most_diags) = max(reversed(files), key=lambda count_file: count_file[0])
+        for (_, file) in files:
+            if most_diags == file:
                 continue
 
-            if not most_diags.file.endswith(".skip") and diag_file.file.endswith(".skip"):
-                shutil.copy(most_diags.file, diag_file.file.with_suffix(""))
+            if not most_diags.name.endswith(".skip") and file.name.endswith(".skip"):
+                link_or_copy(most_diags, file.with_suffix(""))
             else:
-                shutil.copy(most_diags.file, diag_file.file)
+                link_or_copy(most_diags, file)
 
 
 def print_file_diff(file1: Path, file2: Path):
@@ -136,78 +146,83 @@ def print_file_diff(file1: Path, file2: Path):
             print('File "added" ', file, freq)
 
 
+def save_atomic(diag_file: DiagnosticsFile, out: Path):
+    "Saves through a temporary file so out is never left half written"
+    tmp = out.with_name(out.name + f".{os.getpid()}.tmp")
+    diag_file.save(tmp)
+    os.replace(tmp, out)
+
+
+def mutate_file(file: Path, mutations):
+    "Streams file through each (mutate, args) in turn and saves the result as a .new file"
+    diag_file = DiagnosticsFile.stream(file)
+    for (mutate, args) in mutations:
+        mutate(diag_file, *args)
+
+    suffix = ".skip.new" if diag_file.file.suffix == ".skip" else ".new"
+    save_atomic(diag_file, diag_file.file.with_suffix(suffix))
+
+
 def file_mutator(mutate_diag_file):
+    # Mutators replace diag_file.diagnostics with generators so each file is
+    # streamed from disk, through the filter and back out again
     def map_files(files: List[Path], *args):
-        diag_files = [DiagnosticsFile.load(file)
-                      for file in files
-                      if not ".skip" in file.suffix]
+        for file in files:
+            if ".skip" in file.suffix:
+                continue
+
+            mutate_file(file, [(mutate_diag_file, args)])
 
-        for diag_file in diag_files:
-            mutate_diag_file(diag_file, *args)
-            suffix = ".skip.new" if diag_file.file.suffix == ".skip" else ".new"
-            diag_file.save(diag_file.file.with_suffix(suffix))
+    # Kept so pipeline can chain several mutators over one pass of a file
+    map_files.mutate = mutate_diag_file
 
     return map_files
 
 
 @file_mutator
 def remove_diag_type(diag_file: DiagnosticsFile, diag_type: str):
-    diag_file.diagnostics = [
+    diag_file.diagnostics = (
         diag
         for diag in diag_file.diagnostics
         if diag_type not in diag._type
-    ]
+    )
 
 
 @file_mutator
 def remove_file(diag_file: DiagnosticsFile, filename: str):
-    diag_file.diagnostics = [
+    diag_file.diagnostics = (
         diag
         for diag in diag_file.diagnostics
         if filename not in diag._file
-    ]
+    )
 
 
 @file_mutator
 def filter_file(diag_file: DiagnosticsFile, filename: str):
-    diag_file.diagnostics = [
+    diag_file.diagnostics = (
         diag
         for diag in diag_file.diagnostics
         if filename in diag._file
-    ]
-
-
-cache = {}
-
-last_commit = ""
+    )
 
 
 def does_file_exist(project: Path, commit: str, file: str):
-    global last_commit, cache
-
-    if last_commit != commit:
-        githelpers.checkout(project, commit)
-
-    last_commit = commit
-
-    fid = commit + file
-    if fid not in cache:
-        cache[fid] = (project / file).is_file()
-
-    return cache[fid]
+    return githelpers.files_exist(project, commit, [file])[0]
 
 
 @file_mutator
 def remove_missing_files(diag_file: DiagnosticsFile, project: Path):
     print(f"{diag_file.seq} {diag_file.commit}")
 
-    files = githelpers.get_all_files_in_commit(project, diag_file.commit)
+    diagnostics = list(diag_file.diagnostics)
+    files = list(set(diag._file for diag in diagnostics))
+    exists = dict(zip(files, githelpers.files_exist(project, diag_file.commit, files)))
 
-    diag_file.diagnostics = [
+    diag_file.diagnostics = (
         diag
-        for diag in diag_file.diagnostics
-        if diag._file in files
-    ]
+        for diag in diagnostics
+        if exists[diag._file]
+    )
 
 
 def get_relative_file(filepath):
@@ -222,42 +237,34 @@ def get_relative_file(filepath):
 
 @file_mutator
 def relative_files(diag_file):
-    for diag in diag_file.diagnostics:
-        diag._file = get_relative_file(diag._file)
+    diag_file.diagnostics = (diag.replace(file=get_relative_file(diag._file))
+                             for diag in diag_file.diagnostics)
 
 
 @file_mutator
 def stitch_files(diag_file, other_files: List[Path]):
-    other_file = DiagnosticsFile.load(next((file for file in other_files
-                                            if diag_file.commit in file.name)))
+    other_file = DiagnosticsFile.stream(next((file for file in other_files
+                                              if diag_file.commit in file.name)))
 
-    diag_file.diagnostics = [*diag_file.diagnostics, *other_file.diagnostics]
+    diag_file.diagnostics = itertools.chain(diag_file.diagnostics,
+                                            other_file.diagnostics)
 
 
 @file_mutator
 def sort_diag_descriptions(diag_file, diag_type: str):
-    def sort_diag_desc(diag: Diagnostic):
-        diag._raw = [
-            diag._raw[0],
-            diag._raw[1],
-            *sorted(diag._raw[2:])
-        ]
-
-        return diag
-
-    diag_file.diagnostics = [
-        sort_diag_desc(diag) if diag_type in diag._type else diag
+    diag_file.diagnostics = (
+        diag.replace(description=sorted(diag._description)) if diag_type in diag._type else diag
         for diag in diag_file.diagnostics
-    ]
+    )
 
 
 @file_mutator
 def filter_diag_type(diag_file, diag_type: str):
-    diag_file.diagnostics = [
-        diag 
+    diag_file.diagnostics = (
+        diag
         for diag in diag_file.diagnostics
         if diag_type in diag._type
-    ]
+    )
 
 
 def list_files(folder: Path):
@@ -266,6 +273,47 @@ def list_files(folder: Path):
             if os.path.isfile(os.path.join(folder, file))]
 
 
+# Mutators usable in a pipeline, with how to turn their argument into what they take
+MUTATORS = {
+    "remove-diag-type": (remove_diag_type, str),
+    "remove-file": (remove_file, str),
+    "filter-diag-type": (filter_diag_type, str),
+    "filter-file": (filter_file, str),
+    "remove-missing-files": (remove_missing_files, Path),
+    "relative-files": (relative_files, None),
+    "merge": (stitch_files, lambda folder: list_files(Path(folder))),
+    "sort-diag-desc": (sort_diag_descriptions, str),
+}
+
+
+def parse_steps(steps: List[str]):
+    "Turns each name or name=argument into (name, args)"
+    parsed = []
+    for step in steps:
+        (name, _, arg) = step.partition("=")
+        if name not in MUTATORS:
+            raise Exception(name + " is not a mutator")
+
+        parse_arg = MUTATORS[name][1]
+        parsed.append((name, () if parse_arg is None else (parse_arg(arg),)))
+
+    return parsed
+
+
+def _pipeline_file(job):
+    (file, steps) = job
+    mutate_file(file, [(MUTATORS[name][0].mutate, args) for (name, args) in steps])
+
+
+def pipeline(files: List[Path], steps, workers: int = None):
+    "Applies every step in order to each file in a single pass, files in parallel"
+    jobs = [(file, steps) for file in files if ".skip" not in file.suffix]
+
+    with multiprocessing.Pool(workers) as pool:
+        for _ in pool.imap_unordered(_pipeline_file, jobs):
+            pass
+
+
 if __name__ == "__main__":
     cmd = sys.argv[1]
 
@@ -301,5 +349,10 @@ if __name__ == "__main__":
     elif cmd == "sort-diag-desc":
         sort_diag_descriptions([Path(file)
                                 for file in sys.argv[3:]], sys.argv[2])
+    elif cmd == "pipeline":
+        # pipeline <mutator>[=<argument>] ... -- <files>
+        split = sys.argv.index("--")
+        pipeline([Path(file) for file in sys.argv[split+1:]],
+                 parse_steps(sys.argv[2:split]))
     else:
         raise Exception(cmd + " does not exist")
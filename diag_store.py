@@ -0,0 +1,316 @@
+#!/bin/python3
+import mmap
+import os
+import struct
+import sys
+import time
+
+from array import array
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from diag_utils import Diagnostic, DiagnosticsFile
+
+# A diagnostics/<project> folder packed into one file:
+#
+#   header   magic, number of commits, number of diagnostics
+#   sections (offset, length) of every entry in SECTIONS, each 8 byte aligned
+#
+# Diagnostics are stored as one row per diagnostic across the column
+# sections, grouped by commit. commit_offsets[i]:commit_offsets[i+1] are the
+# rows belonging to the i-th commit. Filenames and descriptions (every line
+# after the location) are interned into string tables and referenced by id.
+# stats holds the (mtime_ns, size) each file had when converted, so a store
+# is only used while the folder still holds exactly those files unchanged.
+# Arrays are written in native byte order.
+MAGIC = b"DIAGSTR2"
+HEADER = struct.Struct("=8sQQ")
+SECTION = struct.Struct("=QQ")
+
+SECTIONS = [
+    ("seqs", "q"),
+    ("commit_offsets", "q"),
+    ("commits", None),
+    ("names", None),
+    ("stats", "q"),
+    ("file_id", "I"),
+    ("line", "i"),
+    ("col", "i"),
+    ("start", "i"),
+    ("pos", "i"),
+    ("end", "i"),
+    ("description_id", "I"),
+    ("files", None),
+    ("descriptions", None),
+]
+
+COLUMNS = ["file_id", "line", "col", "start", "pos", "end", "description_id"]
+
+
+def store_path(folder: Path) -> Path:
+    return folder.parent / (folder.name + ".diagstore")
+
+
+def _pack_strings(strings: List[str]) -> bytes:
+    blobs = [string.encode("utf-8") for string in strings]
+
+    offsets = array("q", [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+
+    return struct.pack("=Q", len(blobs)) + offsets.tobytes() + b"".join(blobs)
+
+
+class StringTable:
+    def __init__(self, buffer: memoryview):
+        (count,) = struct.unpack_from("=Q", buffer)
+        offsets_end = 8 + (count + 1) * 8
+
+        self._offsets = buffer[8:offsets_end].cast("q")
+        self._blob = buffer[offsets_end:]
+        self._decoded = [None] * count
+
+    def __len__(self):
+        return len(self._decoded)
+
+    def __getitem__(self, i: int) -> str:
+        string = self._decoded[i]
+        if string is None:
+            string = str(self._blob[self._offsets[i]:self._offsets[i+1]], "utf-8")
+            self._decoded[i] = string
+
+        return string
+
+
+class _Interner:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def __call__(self, string: str) -> int:
+        i = self.ids.get(string)
+        if i is None:
+            i = len(self.strings)
+            self.ids[string] = i
+            self.strings.append(string)
+
+        return i
+
+
+def convert(folder: Path, out: Path = None) -> Path:
+    "Packs every diagnostics file in folder into a single store"
+    if out is None:
+        out = store_path(folder)
+
+    diag_files = sorted((DiagnosticsFile.stream(file)
+                         for file in folder.glob("*")
+                         if file.is_file() and not file.name.endswith(".skip")))
+
+    files = _Interner()
+    descriptions = _Interner()
+
+    seqs = array("q")
+    commit_offsets = array("q", [0])
+    commits = []
+    names = []
+    stats = array("q")
+    columns = {column: array(typecode)
+               for (column, typecode) in SECTIONS
+               if column in COLUMNS}
+
+    for diag_file in diag_files:
+        seqs.append(diag_file.seq)
+        commits.append(diag_file.commit)
+        names.append(diag_file.file.name)
+
+        # Taken before reading, so a file rewritten during the conversion looks changed
+        stat = os.stat(diag_file.file)
+        stats.extend((stat.st_mtime_ns, stat.st_size))
+
+        for diag in diag_file.diagnostics:
+            columns["file_id"].append(files(diag._file))
+            columns["line"].append(diag._line)
+            columns["col"].append(diag._col)
+            columns["start"].append(diag._start)
+            columns["pos"].append(diag._pos)
+            columns["end"].append(diag._end)
+            columns["description_id"].append(descriptions("\n".join(diag._description)))
+
+        commit_offsets.append(len(columns["file_id"]))
+
+    sections = {
+        "seqs": seqs.tobytes(),
+        "commit_offsets": commit_offsets.tobytes(),
+        "commits": _pack_strings(commits),
+        "names": _pack_strings(names),
+        "stats": stats.tobytes(),
+        "files": _pack_strings(files.strings),
+        "descriptions": _pack_strings(descriptions.strings),
+        **{column: values.tobytes() for (column, values) in columns.items()}
+    }
+
+    # Written to a temporary file first so readers never map a partial store
+    tmp = out.with_name(out.name + ".tmp")
+    with open(tmp, "wb") as f:
+        offset = HEADER.size + SECTION.size * len(SECTIONS)
+        directory = []
+        for (name, _) in SECTIONS:
+            offset += -offset % 8
+            directory.append((offset, len(sections[name])))
+            offset += len(sections[name])
+
+        f.write(HEADER.pack(MAGIC, len(diag_files), len(columns["file_id"])))
+        for entry in directory:
+            f.write(SECTION.pack(*entry))
+
+        for ((name, _), (offset, _)) in zip(SECTIONS, directory):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(sections[name])
+
+    tmp.replace(out)
+
+    return out
+
+
+class DiagnosticsStore:
+    "A memory mapped view over a store written by convert"
+
+    def __init__(self, path: Path, folder: Path):
+        self.path = path
+        self.folder = folder
+
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buffer = memoryview(self._mmap)
+        magic, self.num_commits, self.num_diagnostics = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise Exception(f"{path} is not a diagnostics store")
+
+        self._sections = {}
+        for (i, (name, typecode)) in enumerate(SECTIONS):
+            offset, length = SECTION.unpack_from(
+                buffer, HEADER.size + i * SECTION.size)
+            section = buffer[offset:offset+length]
+
+            if typecode is None:
+                self._sections[name] = StringTable(section)
+            else:
+                self._sections[name] = section.cast(typecode)
+
+        self.seqs = self._sections["seqs"]
+        self.commit_offsets = self._sections["commit_offsets"]
+        self.commits = self._sections["commits"]
+        self.names = self._sections["names"]
+        self.stats = self._sections["stats"]
+        self.files = self._sections["files"]
+        self.descriptions = self._sections["descriptions"]
+
+    def file_stats(self) -> Dict[str, Tuple[int, int]]:
+        "The (mtime_ns, size) of each file in the folder when it was converted"
+        return {self.names[i]: (self.stats[2*i], self.stats[2*i+1])
+                for i in range(self.num_commits)}
+
+    def column(self, name: str) -> memoryview:
+        return self._sections[name]
+
+    def num_diagnostics_in(self, i: int) -> int:
+        return self.commit_offsets[i+1] - self.commit_offsets[i]
+
+    def diagnostic(self, row: int) -> Diagnostic:
+        columns = self._sections
+        return Diagnostic.from_fields(self.files[columns["file_id"][row]],
+                                      columns["line"][row],
+                                      columns["col"][row],
+                                      columns["start"][row],
+                                      columns["pos"][row],
+                                      columns["end"][row],
+                                      self.descriptions[columns["description_id"][row]].split("\n"))
+
+    def load(self, i: int) -> DiagnosticsFile:
+        return DiagnosticsFile(self.folder / self.names[i],
+                               self.seqs[i],
+                               self.commits[i],
+                               StoredDiagnostics(self, i))
+
+    def load_all(self) -> List[DiagnosticsFile]:
+        return [self.load(i) for i in range(self.num_commits)]
+
+
+class StoredDiagnostics(Sequence):
+    "The diagnostics of one commit, only turned into Diagnostics when first read"
+
+    def __init__(self, store: DiagnosticsStore, i: int):
+        self._store = store
+        self._start = store.commit_offsets[i]
+        self._end = store.commit_offsets[i+1]
+        self._diagnostics = None
+
+    def _materialise(self) -> List[Diagnostic]:
+        if self._diagnostics is None:
+            self._diagnostics = [self._store.diagnostic(row)
+                                 for row in range(self._start, self._end)]
+
+        return self._diagnostics
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, i):
+        return self._materialise()[i]
+
+    def __iter__(self):
+        return iter(self._materialise())
+
+    def __repr__(self):
+        return f"StoredDiagnostics({len(self)})"
+
+
+def folder_stats(folder: Path) -> Dict[str, Tuple[int, int]]:
+    "The (mtime_ns, size) of every diagnostics file convert would pack from folder"
+    stats = {}
+    for entry in os.scandir(folder):
+        if entry.is_file() and not entry.name.endswith(".skip"):
+            stat = entry.stat()
+            stats[entry.name] = (stat.st_mtime_ns, stat.st_size)
+
+    return stats
+
+
+def open_store(folder: Path) -> Optional[DiagnosticsStore]:
+    """Opens the store for folder, unless it is missing, from an older version
+    or any file in the folder was added, removed or changed since it was written.
+    A directory's mtime doesn't change when a file in it is rewritten, so every
+    file is checked, as with a comparisons folder's .diff_index"""
+    path = store_path(folder)
+    if not path.is_file() or not folder.is_dir():
+        return None
+
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+
+    store = DiagnosticsStore(path, folder)
+    if store.file_stats() != folder_stats(folder):
+        return None
+
+    return store
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1]
+
+    if cmd == "convert":
+        for folder in sys.argv[2:]:
+            start = time.time()
+            out = convert(Path(folder))
+            print(f"Wrote {out} in {time.time() - start:.2f}s")
+    elif cmd == "load":
+        start = time.time()
+        diag_files = DiagnosticsFile.load_all(Path(sys.argv[2]))
+        total = sum(len(diag_file.diagnostics) for diag_file in diag_files)
+        print(f"Loaded {len(diag_files)} commits with {total} diagnostics "
+              f"in {time.time() - start:.3f}s")
+    else:
+        raise Exception("unknown command " + cmd)
@@ -2,9 +2,16 @@
 import sys
 import os
 import os.path
+import shutil
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
+import time
 
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
 
 from githelpers import get_all_commits
 
@@ -24,28 +31,87 @@ def _parse_diag_message(lines):
     return "\n".join(lines)
 
 
+# Every distinct description is kept once, along with the type and message
+# parsed from it, so diagnostics repeated across commits share their strings
+_descriptions = {}
+
+
+def _intern_description(description) -> tuple:
+    key = tuple(description)
+
+    interned = _descriptions.get(key)
+    if interned is None:
+        lines = tuple(sys.intern(line) for line in key)
+        interned = (lines,
+                    sys.intern(get_diag_type(lines[0])),
+                    sys.intern(_parse_diag_message(["", "", *lines])))
+        _descriptions[lines] = interned
+
+    return interned
+
+
 class Diagnostic:
+    """
+    A diagnostic, treated as immutable: equality and hashing go through _key
+    and _hash, which are only computed once, so use replace rather than
+    assigning to fields. Strings are interned so equal diagnostics share them.
+    """
+    __slots__ = ("_file", "_line", "_col", "_start", "_pos", "_end",
+                 "_description", "_type", "_message", "_key", "_hash")
+
     def __init__(self, lines):
         loc_info = lines[1].split(" ")
 
-        self._raw = lines[:]
-        self._file = loc_info[0]
-        self._line = int(loc_info[1])
-        self._col = int(loc_info[2])
-        self._start = int(loc_info[3])
-        self._pos = int(loc_info[4])
-        self._end = int(loc_info[5])
-        self._type = get_diag_type(lines[2])
-        self._message = _parse_diag_message(lines)
+        self._set(loc_info[0], int(loc_info[1]), int(loc_info[2]),
+                  int(loc_info[3]), int(loc_info[4]), int(loc_info[5]), lines[2:])
+
+    def _set(self, file: str, line: int, col: int, start: int, pos: int, end: int, description):
+        (description, diag_type, message) = _intern_description(description)
+        file = sys.intern(file)
+        key = (file, line, col, start, pos, end, message)
+
+        self._file = file
+        self._line = line
+        self._col = col
+        self._start = start
+        self._pos = pos
+        self._end = end
+        self._description = description
+        self._type = diag_type
+        self._message = message
+        self._key = key
+        self._hash = hash(key)
+
+    @classmethod
+    def from_fields(cls, file: str, line: int, col: int, start: int, pos: int, end: int,
+                    description: List[str]):
+        "Builds a diagnostic from its location and the lines describing it"
+        diag = cls.__new__(cls)
+        diag._set(file, line, col, start, pos, end, description)
+
+        return diag
+
+    def replace(self, **fields) -> "Diagnostic":
+        "A copy with some of file, line, col, start, pos, end and description changed"
+        values = {"file": self._file, "line": self._line, "col": self._col,
+                  "start": self._start, "pos": self._pos, "end": self._end,
+                  "description": self._description}
+        values.update(fields)
+
+        return Diagnostic.from_fields(**values)
+
+    @property
+    def _raw(self) -> List[str]:
+        return ["----DIAGNOSTIC",
+                f"{self._file} {self._line} {self._col} {self._start} {self._pos} {self._end}",
+                *self._description]
+
+    def __reduce__(self):
+        return (Diagnostic.from_fields, (self._file, self._line, self._col, self._start,
+                                         self._pos, self._end, self._description))
 
     def __eq__(self, other):
-        return self._file == other._file and \
-            self._line == other._line and \
-            self._col == other._col and \
-            self._message == other._message and \
-            self._start == other._start and \
-            self._pos == other._pos and \
-            self._end == other._end
+        return self._key == other._key
 
     def __repr__(self):
         return f"({self._file} {self._type} {self._line} {self._col} {self._start} {self._end})"
@@ -54,11 +120,11 @@ class Diagnostic:
         return '\n'.join([
             "----DIAGNOSTIC",
             f"{self._file} {self._line} {self._col} {self._start} {self._pos} {self._end}",
-            *self._raw[2:]
+            *self._description
         ])
 
     def __hash__(self):
-        return hash((self._file, self._line, self._col, self._type, self._start, self._pos, self._end))
+        return self._hash
 
     def __lt__(self, other):
         if self._file != other._file:
@@ -88,13 +154,17 @@ def by_delim(items, delim):
 
 
 def parse_diagnostics(lines):
-    if len(lines) == 0:
-        return []
-
-    for diag_lines in by_delim(lines, "----DIAGNOSTIC"):
-        if len(diag_lines) <= 1:
-            continue
-
+    "Lazily parses diagnostics from any iterable of lines in a single pass"
+    diag_lines = None
+    for line in lines:
+        if line == "----DIAGNOSTIC":
+            if diag_lines is not None and len(diag_lines) > 1:
+                yield Diagnostic(diag_lines)
+            diag_lines = [line]
+        elif diag_lines is not None:
+            diag_lines.append(line)
+
+    if diag_lines is not None and len(diag_lines) > 1:
         yield Diagnostic(diag_lines)
 
 
@@ -102,34 +172,96 @@ def read_stripped_lines(file):
     return [line.strip() for line in open(file).readlines()]
 
 
+def stream_stripped_lines(file):
+    with open(file) as f:
+        for line in f:
+            yield line.strip()
+
+
+def stream_diagnostics(file: Path) -> Iterator[Diagnostic]:
+    "Yields the diagnostics in a file one at a time without reading it all in"
+    return parse_diagnostics(stream_stripped_lines(file))
+
+
 class DiagnosticsFile:
     def __init__(self, file: Path, seq: int, commit: str, diagnostics: List[Diagnostic]):
         self.file = file
         self.seq = seq
         self.commit = commit
         self.diagnostics = diagnostics
+        self._diagnostic_set = None
+
+    @property
+    def diagnostic_set(self):
+        "diagnostics as a diagset.DiagnosticSet, rebuilt if diagnostics is replaced"
+        if self._diagnostic_set is None or self._diagnostic_set[0] is not self.diagnostics:
+            from diagset import DiagnosticSet
+            self._diagnostic_set = (self.diagnostics, DiagnosticSet(self.diagnostics))
+
+        return self._diagnostic_set[1]
 
     @classmethod
     def load(cls, file: Path):
+        diag_file = cls.stream(file)
+        diag_file.diagnostics = list(diag_file.diagnostics)
+
+        return diag_file
+
+    @classmethod
+    def stream(cls, file: Path):
+        "Like load but diagnostics is a generator that reads the file as it is consumed"
         seq, commit = file.with_suffix('').stem.split(" ")
-        diagnostics = list(parse_diagnostics(read_stripped_lines(file)))
 
-        return cls(file, int(seq), commit, diagnostics)
+        return cls(file, int(seq), commit, stream_diagnostics(file))
 
     @classmethod
-    def load_all(cls, folder: Path):
+    def load_all(cls, folder: Path, workers: int = None):
+        "Pass workers to parse the files over a process pool"
+        import diag_store
+        store = diag_store.open_store(folder)
+        if store is not None:
+            return store.load_all()
+
+        files = [file for file in folder.glob("*")
+                 if file.is_file() and not file.name.endswith(".skip")]
+
+        if workers is None:
+            return sorted([cls.load(file) for file in files])
+
+        with multiprocessing.Pool(workers) as pool:
+            parsed = pool.map(_parse_diagnostics_file, files,
+                              chunksize=_chunksize(len(files), workers))
+
         return sorted([
-            cls.load(file)
-            for file in folder.glob("*")
-            if file.is_file() and not file.name.endswith(".skip")
+            cls(file, seq, commit, [diag_from_tuple(diag) for diag in diags])
+            for (file, (seq, commit, diags)) in zip(files, parsed)
         ])
 
     def save(self, out: Path):
+        if not isinstance(self.diagnostics, list):
+            self._save_streamed(out)
+            return
+
         with open(out, "w") as f:
             f.write(f"{self.commit} {len(self.diagnostics)}\n")
             for diag in self.diagnostics:
                 f.write(str(diag) + "\n")
 
+    def _save_streamed(self, out: Path):
+        # The header needs the count up front, so spool the body to disk first
+        body = out.with_name(out.name + ".body")
+        total = 0
+        with open(body, "w") as f:
+            for diag in self.diagnostics:
+                f.write(str(diag) + "\n")
+                total += 1
+
+        with open(out, "w") as f, open(body) as body_f:
+            f.write(f"{self.commit} {total}\n")
+            shutil.copyfileobj(body_f, f)
+
+        os.remove(body)
+
     def __eq__(self, other):
         return self.commit == other.commit
 
@@ -150,10 +282,71 @@ def strip_grain_info(file):
         return file
 
 
+UNMATCHED_OLD = b"--------Unmatched old"
+UNMATCHED_NEW = b"--------Unmatched new"
+
+DIFF_INDEX = ".diff_index"
+
+
+class DiffSections(NamedTuple):
+    "Byte offsets of the sections in a diff file along with their totals"
+    unmatched_old: int
+    unmatched_new: int
+    size: int
+    num_matches: int
+    num_unmatched_old: int
+    num_unmatched_new: int
+
+
+def _read_total(data, offset: int) -> int:
+    # Each section starts with a "Total <n>" line
+    end = data.find(b"\n", offset)
+    if end == -1:
+        end = len(data)
+    return int(data[offset:end].split()[1])
+
+
+def scan_diff_sections(file: Path) -> DiffSections:
+    with open(file, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with data:
+        unmatched_old = data.find(b"\n" + UNMATCHED_OLD + b"\n") + 1
+        unmatched_new = data.find(b"\n" + UNMATCHED_NEW + b"\n", unmatched_old) + 1
+        if unmatched_old == 0 or unmatched_new == 0:
+            raise ValueError(f"{file} is missing an unmatched section")
+
+        return DiffSections(unmatched_old,
+                            unmatched_new,
+                            len(data),
+                            _read_total(data, 0),
+                            _read_total(data, unmatched_old + len(UNMATCHED_OLD) + 1),
+                            _read_total(data, unmatched_new + len(UNMATCHED_NEW) + 1))
+
+
+def load_diff_index(folder: Path) -> Dict[str, list]:
+    try:
+        with open(folder / DIFF_INDEX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_diff_index(folder: Path, index: Dict[str, list]):
+    try:
+        with open(folder / DIFF_INDEX, "w") as f:
+            json.dump(index, f)
+    except OSError:
+        pass  # Read only folders just don't get an index
+
+
 class DiagnosticsDiff:
-    "Describes the differences in diagnostics between two commits"
+    """Describes the differences in diagnostics between two commits
 
-    def __init__(self, file: Path):
+    Nothing is parsed until matches, unmatched_old or unmatched_new is first
+    accessed, and then only the section asked for is read."""
+
+    def __init__(self, file: Path, sections: DiffSections = None):
         self.file = file
         # "<pre> [commit] -> <post> [commit]"
         file_split = file.stem.split(" ")
@@ -166,39 +359,169 @@ class DiagnosticsDiff:
             self.pre = int(file_split[0])
             self.post = int(file_split[2])
 
-        self.matches = {}
-        self.unmatched_old = []
-        self.unmatched_new = []
-
-        self._read_file(file)
+        self._sections = sections
+        self._matches = None
+        self._unmatched_old = None
+        self._unmatched_new = None
+        self._unmatched_old_set = None
+        self._unmatched_new_set = None
+
+    @property
+    def sections(self) -> DiffSections:
+        if self._sections is None:
+            self._sections = scan_diff_sections(self.file)
+        return self._sections
+
+    def _read_lines(self, start: int, end: int) -> List[str]:
+        with open(self.file, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+
+        return [line.strip() for line in io.TextIOWrapper(io.BytesIO(data))]
+
+    def _stream_lines(self, start: int, end: int) -> Iterator[str]:
+        with open(self.file, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            for line in f:
+                if remaining <= 0:
+                    return
+
+                yield line[:remaining].decode("utf-8").strip()
+                remaining -= len(line)
+
+    @property
+    def matches(self) -> Dict[Diagnostic, Diagnostic]:
+        if self._matches is None:
+            # Include the "--------Unmatched old" line so the last match ends
+            # exactly where it would when parsing the whole file
+            sections = self.sections
+            self._matches = self._read_matches(self._read_lines(
+                0, sections.unmatched_old + len(UNMATCHED_OLD)))
+        return self._matches
+
+    @matches.setter
+    def matches(self, matches: Dict[Diagnostic, Diagnostic]):
+        self._matches = matches
+
+    @property
+    def unmatched_old(self) -> List[Diagnostic]:
+        if self._unmatched_old is None:
+            sections = self.sections
+            self._unmatched_old = list(parse_diagnostics(self._read_lines(
+                sections.unmatched_old, sections.unmatched_new)[1:]))
+        return self._unmatched_old
+
+    @unmatched_old.setter
+    def unmatched_old(self, unmatched_old: List[Diagnostic]):
+        self._unmatched_old = unmatched_old
+        self._unmatched_old_set = None
+
+    @property
+    def unmatched_new(self) -> List[Diagnostic]:
+        if self._unmatched_new is None:
+            sections = self.sections
+            self._unmatched_new = list(parse_diagnostics(self._read_lines(
+                sections.unmatched_new, sections.size)[1:]))
+        return self._unmatched_new
+
+    @unmatched_new.setter
+    def unmatched_new(self, unmatched_new: List[Diagnostic]):
+        self._unmatched_new = unmatched_new
+        self._unmatched_new_set = None
+
+    @property
+    def unmatched_old_set(self):
+        "unmatched_old as a diagset.DiagnosticSet"
+        if self._unmatched_old_set is None:
+            from diagset import DiagnosticSet
+            self._unmatched_old_set = DiagnosticSet(self.unmatched_old)
+        return self._unmatched_old_set
+
+    @property
+    def unmatched_new_set(self):
+        "unmatched_new as a diagset.DiagnosticSet"
+        if self._unmatched_new_set is None:
+            from diagset import DiagnosticSet
+            self._unmatched_new_set = DiagnosticSet(self.unmatched_new)
+        return self._unmatched_new_set
+
+    @property
+    def num_matches(self) -> int:
+        if self._matches is not None:
+            return len(self._matches)
+        return self.sections.num_matches
+
+    @property
+    def num_unmatched_old(self) -> int:
+        if self._unmatched_old is not None:
+            return len(self._unmatched_old)
+        return self.sections.num_unmatched_old
+
+    @property
+    def num_unmatched_new(self) -> int:
+        if self._unmatched_new is not None:
+            return len(self._unmatched_new)
+        return self.sections.num_unmatched_new
+
+    @staticmethod
+    def _parse_match(match: List[str]):
+        "(old, new) from the lines of one match, or None if it isn't one"
+        if "to" not in match:
+            return None
+
+        end = len(match)
+        if "--------Unmatched old" in match:
+            end = match.index("--------Unmatched old") - 1
+
+        delim = match.index("to")
+        return (Diagnostic(match[1:delim]), Diagnostic(match[delim+1:end]))
 
     def _read_matches(self, lines):
+        matches = {}
         for match in by_delim(lines, "--------Matches"):
-            if "to" not in match:
-                continue
-
-            end = len(match)
-            if "--------Unmatched old" in match:
-                end = match.index("--------Unmatched old") - 1
-
-            delim = match.index("to")
-            old_diag = Diagnostic(match[1:delim])
-            new_diag = Diagnostic(match[delim+1:end])
-
-            self.matches[old_diag] = new_diag
-
-    def _read_file(self, file):
-        lines = [line.strip() for line in open(file).readlines()]
-
-        self._read_matches(lines)
-
-        unmatched_old = lines.index("--------Unmatched old")
-        unmatched_new = lines.index("--------Unmatched new")
-
-        self.unmatched_old.extend([diag for diag in
-                                   parse_diagnostics(lines[unmatched_old+1:unmatched_new])])
-        self.unmatched_new.extend([diag for diag in
-                                   parse_diagnostics(lines[unmatched_new+1:])])
+            parsed = self._parse_match(match)
+            if parsed is not None:
+                matches[parsed[0]] = parsed[1]
+
+        return matches
+
+    def iter_matches(self) -> Iterator[Tuple[Diagnostic, Diagnostic]]:
+        """Yields the matches one at a time as they are read from file, never
+        holding the whole section. Unlike matches an old diagnostic matched
+        twice in the file is yielded twice."""
+        if self._matches is not None:
+            yield from self._matches.items()
+            return
+
+        match = []
+        for line in self._stream_lines(0, self.sections.unmatched_old + len(UNMATCHED_OLD)):
+            if line == "--------Matches" and len(match) > 0:
+                parsed = self._parse_match(match)
+                if parsed is not None:
+                    yield parsed
+                match = []
+            match.append(line)
+
+        parsed = self._parse_match(match)
+        if parsed is not None:
+            yield parsed
+
+    def iter_unmatched_old(self) -> Iterator[Diagnostic]:
+        if self._unmatched_old is not None:
+            return iter(self._unmatched_old)
+
+        sections = self.sections
+        return parse_diagnostics(itertools.islice(
+            self._stream_lines(sections.unmatched_old, sections.unmatched_new), 1, None))
+
+    def iter_unmatched_new(self) -> Iterator[Diagnostic]:
+        if self._unmatched_new is not None:
+            return iter(self._unmatched_new)
+
+        sections = self.sections
+        return parse_diagnostics(itertools.islice(
+            self._stream_lines(sections.unmatched_new, sections.size), 1, None))
 
     def write(self, path: Path):
         with open(path, "w") as file:
@@ -221,6 +544,15 @@ class DiagnosticsDiff:
             for diag in self.unmatched_new:
                 write_line(diag)
 
+    def __getstate__(self):
+        # Pickled diffs, such as those in a saved LineageIndex, reread what
+        # they are asked for from file rather than carrying it along
+        state = self.__dict__.copy()
+        for field in ("_matches", "_unmatched_old", "_unmatched_new",
+                      "_unmatched_old_set", "_unmatched_new_set"):
+            state[field] = None
+        return state
+
     def __lt__(self, other):
         return self.pre < other.pre
 
@@ -236,10 +568,90 @@ class DiagnosticsDiff:
         return hash((self.pre_commit, self.post_commit))
 
     @classmethod
-    def load_all(cls, folder: Path):
-        return sorted((cls(file)
-                       for file in folder.glob("* -> *")
-                       if file.is_file()))
+    def load_all(cls, folder: Path, workers: int = None):
+        """Costs a directory listing plus a scan of any file missing from the folder's index.
+
+        Pass workers to instead parse every diff up front over a process pool"""
+        # A missing folder has no diffs, as globbing it used to find
+        if not folder.is_dir():
+            return []
+
+        index = load_diff_index(folder)
+
+        entries = []
+        for entry in os.scandir(folder):
+            if " -> " not in entry.name or not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            indexed = index.get(entry.name)
+            if indexed is not None and indexed[:2] == [stat.st_mtime_ns, stat.st_size]:
+                sections = DiffSections(*indexed[2:])
+            else:
+                sections = None
+
+            entries.append((Path(entry.path), stat, sections))
+
+        if workers is None:
+            diffs = [cls(file, sections or scan_diff_sections(file))
+                     for (file, _, sections) in entries]
+        else:
+            with multiprocessing.Pool(workers) as pool:
+                parsed = pool.starmap(_parse_diff_file,
+                                      [(file, sections) for (file, _, sections) in entries],
+                                      chunksize=_chunksize(len(entries), workers))
+
+            diffs = [cls._from_tuples(file, *diff_tuples)
+                     for ((file, _, _), diff_tuples) in zip(entries, parsed)]
+
+        new_index = {diff.file.name: [stat.st_mtime_ns, stat.st_size, *diff.sections]
+                     for ((_, stat, _), diff) in zip(entries, diffs)}
+        if new_index != index:
+            save_diff_index(folder, new_index)
+
+        return sorted(diffs)
+
+    def _to_tuples(self):
+        return (tuple(self.sections),
+                [(diag_to_tuple(old), diag_to_tuple(new))
+                 for (old, new) in self.matches.items()],
+                [diag_to_tuple(diag) for diag in self.unmatched_old],
+                [diag_to_tuple(diag) for diag in self.unmatched_new])
+
+    @classmethod
+    def _from_tuples(cls, file: Path, sections, matches, unmatched_old, unmatched_new):
+        diff = cls(file, DiffSections(*sections))
+        diff.matches = {diag_from_tuple(old): diag_from_tuple(new)
+                        for (old, new) in matches}
+        diff.unmatched_old = [diag_from_tuple(diag) for diag in unmatched_old]
+        diff.unmatched_new = [diag_from_tuple(diag) for diag in unmatched_new]
+
+        return diff
+
+
+# Worker processes send diagnostics back as plain tuples, which pickle far
+# smaller and faster than Diagnostic objects
+def diag_to_tuple(diag: Diagnostic) -> tuple:
+    return (diag._file, diag._line, diag._col, diag._start, diag._pos, diag._end,
+            "\n".join(diag._description))
+
+
+def diag_from_tuple(diag: tuple) -> Diagnostic:
+    return Diagnostic.from_fields(*diag[:6], diag[6].split("\n"))
+
+
+def _chunksize(num_files: int, workers: int) -> int:
+    return max(1, num_files // (workers * 4))
+
+
+def _parse_diagnostics_file(file: Path):
+    diag_file = DiagnosticsFile.stream(file)
+    return (diag_file.seq, diag_file.commit,
+            [diag_to_tuple(diag) for diag in diag_file.diagnostics])
+
+
+def _parse_diff_file(file: Path, sections: DiffSections):
+    return DiagnosticsDiff(file, sections)._to_tuples()
 
 
 def get_added_diagnostics(diffs: List[DiagnosticsDiff], commit: str):
@@ -256,6 +668,49 @@ def get_removed_diagnostics(diffs: List[DiagnosticsDiff], commit: str):
     return diff.unmatched_old
 
 
+class DiffTimeline:
+    """Consecutive diffs indexed by their pre and post commits, so looking up a
+    diff or the run of diffs between two commits doesn't scan the list."""
+
+    def __init__(self, diffs: List[DiagnosticsDiff]):
+        self.diffs = list(diffs)
+        self._by_pre = {}
+        self._by_post = {}
+        self._by_pair = {}
+
+        # Earliest wins, as scanning from the front would find
+        for (i, diff) in enumerate(self.diffs):
+            self._by_pre.setdefault(diff.pre_commit, i)
+            self._by_post.setdefault(diff.post_commit, i)
+            self._by_pair.setdefault((diff.pre_commit, diff.post_commit), i)
+
+    def __len__(self):
+        return len(self.diffs)
+
+    def __getitem__(self, i):
+        return self.diffs[i]
+
+    def __iter__(self):
+        return iter(self.diffs)
+
+    def index_of_pre(self, pre_commit: str) -> int:
+        return self._by_pre[pre_commit]
+
+    def index_of_post(self, post_commit: str) -> int:
+        return self._by_post[post_commit]
+
+    def get(self, pre_commit: str, post_commit: str) -> DiagnosticsDiff:
+        return self.diffs[self._by_pair[(pre_commit, post_commit)]]
+
+    def span(self, pre_commit: str, post_commit: str):
+        "(start, end) of the diffs leading from pre_commit to post_commit"
+        return self.index_of_pre(pre_commit), self.index_of_post(post_commit) + 1
+
+    def between(self, pre_commit: str, post_commit: str) -> List[DiagnosticsDiff]:
+        (start, end) = self.span(pre_commit, post_commit)
+        return self.diffs[start:end]
+
+
 def find_when_leaves(diffs: List[DiagnosticsDiff],
                      diagnostic: Diagnostic,
                      start: int = 0,
@@ -263,16 +718,186 @@ def find_when_leaves(diffs: List[DiagnosticsDiff],
     if end is None:
         end = len(diffs)
 
-    if diagnostic in diffs[start].unmatched_new:
+    if diagnostic in diffs[start].unmatched_new_set:
         start += 1
 
     for cur in range(start, min(end, len(diffs))):
         file = diffs[cur]
 
         # Does it leave in this commit?
-        if diagnostic in file.unmatched_old:
+        if diagnostic in file.unmatched_old_set:
             return cur
         else:
             diagnostic = file.matches[diagnostic]
 
     return end
+
+
+class LineageIndex:
+    """Links diagnostics through the matches of consecutive diffs into tracks.
+
+    Position i is the pre commit of diffs[i], and position len(diffs) is the
+    post commit of the last diff. Every diagnostic alive at a position belongs
+    to exactly one track, which records the diff it was added in and the diff
+    it leaves in. Diffs can be appended as they arrive.
+
+    Rather than what is alive at every position, each diagnostic keeps the runs
+    of positions it stays on one track for, so the index grows with how much
+    diagnostics change rather than with diagnostics times commits."""
+
+    def __init__(self, diffs: List[DiagnosticsDiff] = ()):
+        self.diffs = []
+        self.enters = []
+        self._leaves = []
+        self._joined = {}
+
+        # diagnostic -> [start, end, track, ...] in order, end None while alive
+        self._runs: Dict[Diagnostic, list] = {}
+        self._alive: Dict[Diagnostic, int] = {}
+        self._added: List[Set[Diagnostic]] = []
+
+        for diff in diffs:
+            self.append(diff)
+
+    def __len__(self):
+        return len(self.diffs)
+
+    def _new_track(self, enters: int) -> int:
+        self.enters.append(enters)
+        self._leaves.append(None)
+        return len(self.enters) - 1
+
+    def _root(self, track: int) -> int:
+        while track in self._joined:
+            track = self._joined[track]
+        return track
+
+    def _continue(self, alive: Dict[Diagnostic, int], diag: Diagnostic, track: int):
+        # Equal diagnostics can't be told apart after this point, so they share a future
+        if diag in alive and alive[diag] != track:
+            self._joined[track] = alive[diag]
+        else:
+            alive[diag] = track
+
+    def _start_runs(self, alive: Dict[Diagnostic, int], previous: Dict[Diagnostic, int], position: int):
+        for (diag, track) in alive.items():
+            if previous.get(diag) != track:
+                self._runs.setdefault(diag, []).extend([position, None, track])
+
+    def append(self, diff: DiagnosticsDiff):
+        i = len(self.diffs)
+        if i == 0:
+            self._alive = {diag: self._new_track(0)
+                           for diag in itertools.chain(diff.unmatched_old, diff.matches.keys())}
+            self._start_runs(self._alive, {}, 0)
+
+        alive = self._alive
+        unmatched_old = set(diff.unmatched_old)
+        next_alive = {}
+
+        for (old, new) in diff.matches.items():
+            if old in unmatched_old:
+                continue
+
+            track = alive.get(old)
+            if track is None:
+                track = self._new_track(i)
+            self._continue(next_alive, new, track)
+
+        for (diag, track) in alive.items():
+            if diag in unmatched_old or diag not in diff.matches:
+                self._leaves[self._root(track)] = i
+
+        for diag in diff.unmatched_new:
+            self._continue(next_alive, diag, self._new_track(i))
+
+        # A run ends where its diagnostic leaves or carries on in another track
+        for (diag, track) in alive.items():
+            if next_alive.get(diag) != track:
+                self._runs[diag][-2] = i + 1
+        self._start_runs(next_alive, alive, i + 1)
+
+        self.diffs.append(diff)
+        self._alive = next_alive
+        self._added.append(set(diff.unmatched_new))
+
+    def _track_at(self, diagnostic: Diagnostic, position: int) -> Optional[int]:
+        runs = self._runs.get(diagnostic, ())
+        for run in range(len(runs) - 3, -1, -3):
+            (start, end, track) = runs[run:run+3]
+            if start <= position:
+                return track if end is None or position < end else None
+
+        return None
+
+    def track(self, diagnostic: Diagnostic, position: int = 0) -> int:
+        "The track of a diagnostic present at position"
+        track = self._track_at(diagnostic, position)
+        if track is None:
+            raise KeyError(diagnostic)
+
+        return self._root(track)
+
+    def leaves(self, track: int) -> int:
+        "Index of the diff a track leaves in, or len(diffs) if it is still alive"
+        leaves = self._leaves[self._root(track)]
+        return len(self.diffs) if leaves is None else leaves
+
+    def alive_at(self, position: int) -> List[Diagnostic]:
+        return [diag for diag in self._runs if self._track_at(diag, position) is not None]
+
+    def track_from(self, diagnostic: Diagnostic, start: int = 0) -> int:
+        "The track find_when_leaves follows for a diagnostic from start"
+        if start < len(self.diffs) and diagnostic in self._added[start]:
+            start += 1
+
+        return self.track(diagnostic, start)
+
+    def find_when_leaves(self, diagnostic: Diagnostic, start: int = 0, end: int = None) -> int:
+        "Same as find_when_leaves(diffs, diagnostic, start, end) without walking the diffs"
+        if end is None:
+            end = len(self.diffs)
+
+        leaves = self.leaves(self.track_from(diagnostic, start))
+        return leaves if leaves < min(end, len(self.diffs)) else end
+
+
+def bench(folder: Path, repeats: int = 5):
+    "Memory per diagnostic and dict lookup throughput for every diagnostic in folder"
+    import tracemalloc
+
+    files = [file for file in folder.glob("*")
+             if file.is_file() and not file.name.endswith(".skip")]
+
+    tracemalloc.start()
+    start = time.time()
+    diags = [diag for file in files for diag in stream_diagnostics(file)]
+    parse_time = time.time() - start
+    (memory, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"Parsed {len(diags)} diagnostics in {parse_time:.2f}s, "
+          f"{memory / len(diags):.0f} bytes per diagnostic")
+
+    # Look up equal but separately parsed diagnostics, as matching does
+    lookups = [diag for file in files for diag in stream_diagnostics(file)]
+
+    start = time.time()
+    table = {diag: i for (i, diag) in enumerate(diags)}
+    print(f"Built a dict of {len(table)} in {time.time() - start:.2f}s")
+
+    start = time.time()
+    for _ in range(repeats):
+        for diag in lookups:
+            table[diag]
+    elapsed = time.time() - start
+    print(f"{repeats * len(lookups) / elapsed / 1e6:.2f}M lookups/s")
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1]
+
+    if cmd == "bench":
+        bench(Path(sys.argv[2]))
+    else:
+        raise Exception("unknown command " + cmd)
@@ -0,0 +1,105 @@
+import numpy as np
+
+from typing import Iterable, List, Tuple
+
+from diag_utils import Diagnostic
+
+# The fields a diagnostic's key is made of. file and message are interned
+# strings, so equal ones are the same object and id() tells them apart for
+# as long as a diagnostic holding them is alive, which every set's are
+COLUMNS = ["file", "line", "col", "start", "pos", "end", "message"]
+
+
+def key_rows(diags: List[Diagnostic]) -> np.ndarray:
+    "One row of COLUMNS per diagnostic"
+    rows = np.empty((len(diags), len(COLUMNS)), dtype=np.int64)
+    rows[:, 0] = np.fromiter((id(diag._file) for diag in diags), dtype=np.int64, count=len(diags))
+    rows[:, 1] = np.fromiter((diag._line for diag in diags), dtype=np.int64, count=len(diags))
+    rows[:, 2] = np.fromiter((diag._col for diag in diags), dtype=np.int64, count=len(diags))
+    rows[:, 3] = np.fromiter((diag._start for diag in diags), dtype=np.int64, count=len(diags))
+    rows[:, 4] = np.fromiter((diag._pos for diag in diags), dtype=np.int64, count=len(diags))
+    rows[:, 5] = np.fromiter((diag._end for diag in diags), dtype=np.int64, count=len(diags))
+    rows[:, 6] = np.fromiter((id(diag._message) for diag in diags), dtype=np.int64, count=len(diags))
+
+    return rows
+
+
+def shared_ids(rows: np.ndarray, other_rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    "Numbers the distinct rows of both, equal rows getting the same number, only for this comparison"
+    (_, inverse) = np.unique(np.concatenate([rows, other_rows]), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    return (inverse[:len(rows)], inverse[len(rows):])
+
+
+class DiagnosticSet:
+    """
+    Diagnostics with their key fields held as numpy columns, so membership,
+    intersection and difference against whole commits are array operations.
+    Diagnostics are equal when their keys are, as with Diagnostic.__eq__.
+    """
+
+    def __init__(self, diagnostics: Iterable[Diagnostic], rows: np.ndarray = None):
+        self.diagnostics: List[Diagnostic] = list(diagnostics)
+        self.rows = key_rows(self.diagnostics) if rows is None else rows
+        self._index = None
+
+    def __len__(self):
+        return len(self.diagnostics)
+
+    def __iter__(self):
+        return iter(self.diagnostics)
+
+    def __repr__(self):
+        return f"DiagnosticSet({len(self)})"
+
+    def column(self, name: str) -> np.ndarray:
+        "One of COLUMNS, file and message being the id of the string"
+        return self.rows[:, COLUMNS.index(name)]
+
+    def index(self, diagnostic: Diagnostic) -> int:
+        "Row of the first diagnostic equal to diagnostic, or -1"
+        # Single lookups are quicker through the keys diagnostics already hash
+        if self._index is None:
+            self._index = {}
+            for (row, diag) in enumerate(self.diagnostics):
+                self._index.setdefault(diag, row)
+
+        return self._index.get(diagnostic, -1)
+
+    def __contains__(self, diagnostic: Diagnostic) -> bool:
+        return self.index(diagnostic) != -1
+
+    def _ids_with(self, diags) -> Tuple[np.ndarray, np.ndarray]:
+        other_rows = diags.rows if isinstance(diags, DiagnosticSet) else key_rows(list(diags))
+        return shared_ids(self.rows, other_rows)
+
+    def contains(self, diags) -> np.ndarray:
+        "For each of diags, whether an equal diagnostic is in this set"
+        (ids, other_ids) = self._ids_with(diags)
+        return np.isin(other_ids, ids)
+
+    def _take(self, mask: np.ndarray) -> "DiagnosticSet":
+        rows = np.flatnonzero(mask)
+        return DiagnosticSet([self.diagnostics[row] for row in rows.tolist()], self.rows[rows])
+
+    def intersection(self, other) -> "DiagnosticSet":
+        "The diagnostics of this set also in other, in order"
+        (ids, other_ids) = self._ids_with(other)
+        return self._take(np.isin(ids, other_ids))
+
+    def difference(self, other) -> "DiagnosticSet":
+        "The diagnostics of this set not in other, in order"
+        (ids, other_ids) = self._ids_with(other)
+        return self._take(np.isin(ids, other_ids, invert=True))
+
+    def __and__(self, other) -> "DiagnosticSet":
+        return self.intersection(other)
+
+    def __sub__(self, other) -> "DiagnosticSet":
+        return self.difference(other)
+
+    def shared_count(self, other) -> int:
+        "How many distinct diagnostics both sets have"
+        (ids, other_ids) = self._ids_with(other)
+        return len(np.intersect1d(ids, other_ids))
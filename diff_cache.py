@@ -0,0 +1,116 @@
+import os
+
+from array import array
+from pathlib import Path
+
+from githelpers import hash_blob
+from meyersdiff import Hunk, LineMap, myers_hunks
+
+# Shared by every tool run from the same working directory, like dump/
+CACHE_DIR = Path("cache") / "diffs"
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def blob_id(src) -> str:
+    "The id git gives src when stored as a blob"
+    if type(src) is not str:
+        src = "\n".join(src)
+
+    return hash_blob(src.encode("utf-8"))
+
+
+class DiffCache:
+    """
+    Source diffs stored on disk as hunks, keyed by the blob ids of the old
+    and new source. Entries are evicted least recently used first once the
+    cache grows past max_bytes.
+    """
+
+    def __init__(self, folder: Path = CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES):
+        self._folder = folder
+        self._max_bytes = max_bytes
+        self._size = None
+        self._loaded = {}
+
+    def _path(self, old_id: str, new_id: str) -> Path:
+        return self._folder / old_id[:2] / f"{old_id}-{new_id}"
+
+    def _read(self, path: Path):
+        try:
+            with open(path, "rb") as f:
+                fields = array("i", f.read())
+        except OSError:
+            return None
+
+        # Touching the entry is what keeps it from being evicted
+        os.utime(path)
+
+        return [Hunk(*fields[i:i+5]) for i in range(0, len(fields), 5)]
+
+    def _write(self, path: Path, hunks):
+        data = array("i", [field for hunk in hunks for field in hunk]).tobytes()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        tmp.replace(path)
+
+        if self._size is None:
+            self._size = sum(entry.stat().st_size for entry in self._entries())
+        else:
+            self._size += len(data)
+
+        if self._size > self._max_bytes:
+            self._evict()
+
+    def _entries(self):
+        for folder in self._folder.iterdir():
+            if folder.is_dir():
+                yield from (entry for entry in os.scandir(folder)
+                            if entry.is_file() and not entry.name.endswith(".tmp"))
+
+    def _evict(self):
+        "Removes the least recently used entries until the cache is 3/4 full"
+        entries = sorted(((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path)
+                          for entry in self._entries()))
+
+        self._size = sum(size for (_, size, _) in entries)
+        for (_, size, path) in entries:
+            if self._size <= self._max_bytes * 3 // 4:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._size -= size
+
+    def hunks(self, old_src, new_src):
+        key = (blob_id(old_src), blob_id(new_src))
+
+        hunks = self._loaded.get(key)
+        if hunks is None:
+            path = self._path(*key)
+            hunks = self._read(path)
+            if hunks is None:
+                hunks = myers_hunks(old_src, new_src)
+                self._write(path, hunks)
+
+            self._loaded[key] = hunks
+
+        return hunks
+
+    def line_map(self, old_src, new_src) -> LineMap:
+        return LineMap(self.hunks(old_src, new_src))
+
+
+_cache = DiffCache()
+
+
+def load_hunks(old_src, new_src):
+    return _cache.hunks(old_src, new_src)
+
+
+def load_line_map(old_src, new_src) -> LineMap:
+    return _cache.line_map(old_src, new_src)
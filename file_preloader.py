@@ -1,20 +1,177 @@
 #!/bin/python3
 
+import os
+import queue
 import sys
+import threading
+import time
+
+import githelpers
+import java_formatter
 
 from diag_utils import DiagnosticsFile
 from matchhelper2 import FileLoader
 
 from pathlib import Path
 
+BATCH_SIZE = 64
+QUEUE_SIZE = 256
+POLL_SECONDS = 0.1
+
+
+class StageTimer:
+    "Total time spent by every worker of a stage, split into named steps"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.times = {}
+        self._lock = threading.Lock()
+
+    def add(self, step: str, start: float):
+        with self._lock:
+            self.times[step] = self.times.get(step, 0) + time.time() - start
+
+    def __str__(self):
+        return f"{self.name}: " + ", ".join(f"{step} {t:.2f}s" for (step, t) in self.times.items())
+
+
+def write_atomic(path: Path, data: bytes):
+    "Files in the dump only ever appear complete, so an interrupted run can resume"
+    tmp = path.with_name(path.name + f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    tmp.replace(path)
+
+
+def preload(project: Path, diag_files, output: Path, fetchers: int, formatters: int):
+    """
+    Writes the formatted source of every file with a diagnostic into output.
+    Fetch workers read blobs out of git into a bounded queue which formatter
+    workers drain, so the two overlap. Files already in output are skipped.
+    """
+    fl = FileLoader(project, output)
+    output.mkdir(parents=True, exist_ok=True)
+
+    requests = {}
+    for diag_file in diag_files:
+        for file in set(diag._file for diag in diag_file.diagnostics):
+            path = fl._get_file_path(Path(file), diag_file.commit)
+            if path not in requests and not path.exists():
+                requests[path] = (diag_file.commit, file)
+
+    print(f"{len(requests)} files to load")
+    if len(requests) == 0:
+        return
+
+    paths = list(requests)
+    batches = queue.Queue()
+    for i in range(0, len(paths), BATCH_SIZE):
+        batches.put(paths[i:i+BATCH_SIZE])
+
+    sources = queue.Queue(QUEUE_SIZE)
+    fetch_timer = StageTimer("fetch")
+    format_timer = StageTimer("format")
+
+    # The first worker to fail stops both stages, so nothing is left blocked
+    # on the queue, and its error is raised once every worker has finished
+    errors = []
+    failed = threading.Event()
+
+    def worker(target, *args):
+        def run():
+            try:
+                target(*args)
+            except BaseException as e:
+                errors.append(e)
+                failed.set()
+
+        return threading.Thread(target=run)
+
+    def put(item) -> bool:
+        while not failed.is_set():
+            try:
+                sources.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def fetch():
+        reader = githelpers.BlobReader(project)
+        try:
+            while not failed.is_set():
+                try:
+                    batch = batches.get_nowait()
+                except queue.Empty:
+                    return
+
+                start = time.time()
+                responses = reader.read_objects([commit + ":" + str(file)
+                                                 for (commit, file) in map(requests.get, batch)])
+                fetch_timer.add("git", start)
+
+                for (path, response) in zip(batch, responses):
+                    start = time.time()
+                    if not put((path, response[2] if response and response[1] == "blob" else None)):
+                        return
+                    fetch_timer.add("queue full", start)
+        finally:
+            reader.close()
+
+    def format_sources(formatter: java_formatter.FormatterProcess):
+        waiting = time.time()
+        while not failed.is_set():
+            try:
+                item = sources.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            format_timer.add("queue empty", waiting)
+            if item is None:
+                return
+
+            (path, src) = item
+            if src is None:
+                write_atomic(path, b"Does not exist")
+            else:
+                start = time.time()
+                formatted = java_formatter.format_source(src, formatter)
+                format_timer.add("format", start)
+
+                start = time.time()
+                write_atomic(path, formatted)
+                format_timer.add("write", start)
+
+            waiting = time.time()
+
+    start = time.time()
+    format_threads = [worker(format_sources, formatter)
+                      for formatter in java_formatter.get_formatters(formatters)]
+    fetch_threads = [worker(fetch) for _ in range(fetchers)]
+
+    for thread in format_threads + fetch_threads:
+        thread.start()
+
+    for thread in fetch_threads:
+        thread.join()
+    for _ in format_threads:
+        put(None)
+    for thread in format_threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    print(f"Loaded {len(requests)} files in {time.time() - start:.2f}s")
+    print(fetch_timer)
+    print(format_timer)
+
+
 if __name__ == "__main__":
     project = Path(sys.argv[1])
+    fetchers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    formatters = int(sys.argv[3]) if len(sys.argv) > 3 else java_formatter.DEFAULT_WORKERS
+
     diag_files = DiagnosticsFile.load_all(Path("diagnostics") / project)
 
-    fl = FileLoader(project, Path("dump") / project)
-    for diag_file in diag_files:
-        print(diag_file)
-        for file in set(diag._file for diag in diag_file.diagnostics):
-            fl.load(file, diag_file.commit)
-    
-    fl.format_files()
\ No newline at end of file
+    preload(project, diag_files, Path("dump") / project, fetchers, formatters)
@@ -1,10 +1,15 @@
+import bisect
+import hashlib
 import subprocess
 import shutil
 import tempfile
-import re
+import threading
+import os
+import pickle
 
+from array import array
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 
 def get_all_commits(project: Path) -> List[str]:
@@ -35,6 +40,10 @@ def checkout(project: Path, commit: str):
 
 
 def get_all_files_in_commit(project: Path, commit: str):
+    index = get_commit_tree_index(project)
+    if commit in index:
+        return index.files_in_commit(commit)
+
     proc = subprocess.run(["git", "ls-tree", "--full-tree", "-r", commit],
                           cwd=project, stdout=subprocess.PIPE)
 
@@ -50,6 +59,12 @@ def get_all_files_in_commit(project: Path, commit: str):
 
 
 def get_changed_java_files(project: Path, pre_commit: str, post_commit: str):
+    changed_files = get_commit_tree_index(project).changed_files(pre_commit, post_commit)
+    if changed_files is not None:
+        return set((changed_file
+                    for changed_file in changed_files
+                    if Path(changed_file).suffix == ".java"))
+
     proc = subprocess.run(["git", "diff", "--name-only", pre_commit, post_commit],
                           cwd=project, stdout=subprocess.PIPE)
 
@@ -60,15 +75,427 @@ def get_changed_java_files(project: Path, pre_commit: str, post_commit: str):
                 if len(changed_file) > 0 and Path(changed_file).suffix == ".java"))
 
 
+TREE_MODE = b"40000"
+GITLINK_MODE = b"160000"
+
+
+def parse_tree(data: bytes) -> Dict[str, Tuple[bytes, str]]:
+    "Entries of a raw tree object as name -> (mode, sha)"
+    entries = {}
+
+    i = 0
+    while i < len(data):
+        space = data.index(b" ", i)
+        nul = data.index(b"\0", space)
+
+        entries[data[space+1:nul].decode("utf-8", "surrogateescape")] = \
+            (data[i:space], data[nul+1:nul+21].hex())
+        i = nul + 21
+
+    return entries
+
+
+class BlobReader:
+    "Reads objects out of a repository through one long running git cat-file --batch"
+
+    def __init__(self, project: Path):
+        self._proc = subprocess.Popen(["git", "cat-file", "--batch"], cwd=project,
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._lock = threading.Lock()
+
+        # Trees are immutable, so each is only read once however many commits share it
+        self._trees = {}
+        self._roots = {}
+
+    def _read_response(self) -> Optional[Tuple[str, str, bytes]]:
+        # "<sha> <type> <size>" followed by the contents, or "<name> missing"
+        header = self._proc.stdout.readline().decode("utf-8").split(" ")
+        if len(header) < 3 or not header[-1].strip().isdigit():
+            return None
+
+        sha, object_type, size = header[0], header[-2], int(header[-1])
+        data = self._proc.stdout.read(size)
+        self._proc.stdout.read(1)
+
+        return sha, object_type, data
+
+    def read_objects(self, names: List[str]) -> List[Optional[Tuple[str, str, bytes]]]:
+        "Looks up a batch of object names, each None if it does not exist"
+        def write_requests():
+            for name in names:
+                self._proc.stdin.write(name.encode("utf-8") + b"\n")
+            self._proc.stdin.flush()
+
+        with self._lock:
+            # Write from another thread so a large batch can't fill both pipes
+            writer = threading.Thread(target=write_requests)
+            writer.start()
+            responses = [self._read_response() for _ in names]
+            writer.join()
+
+        return responses
+
+    def read_object(self, name: str) -> Optional[Tuple[str, str, bytes]]:
+        return self.read_objects([name])[0]
+
+    def load_files(self, requests: List[Tuple[str, str]]) -> List[Tuple[str, bool]]:
+        "Loads a batch of (commit, file) as load_file would"
+        responses = self.read_objects([commit + ":" + str(file)
+                                       for (commit, file) in requests])
+
+        files = []
+        for response in responses:
+            if response is None or response[1] != "blob":
+                files.append(("Does not exist", False))
+            else:
+                files.append((response[2].decode("utf-8"), True))
+
+        return files
+
+    def _load_trees(self, shas):
+        shas = [sha for sha in shas if sha not in self._trees]
+        for (sha, response) in zip(shas, self.read_objects(shas)):
+            if response is None or response[1] != "tree":
+                self._trees[sha] = {}
+            else:
+                self._trees[sha] = parse_tree(response[2])
+
+    def _root_tree(self, commit: str) -> Optional[str]:
+        if commit not in self._roots:
+            response = self.read_object(commit + "^{tree}")
+            if response is None or response[1] != "tree":
+                self._roots[commit] = None
+            else:
+                (sha, _, data) = response
+                self._trees.setdefault(sha, parse_tree(data))
+                self._roots[commit] = sha
+
+        return self._roots[commit]
+
+    def files_exist(self, commit: str, files: List[str]) -> List[bool]:
+        """
+        Whether each of files is a file at commit, answered from the object
+        store one tree level at a time for the whole batch
+        """
+        exists = [False] * len(files)
+
+        root = self._root_tree(commit)
+        if root is None:
+            return exists
+
+        walks = [(i, str(file).split("/"), root) for (i, file) in enumerate(files)]
+        depth = 0
+        while len(walks) > 0:
+            self._load_trees(set(tree for (_, _, tree) in walks))
+
+            next_walks = []
+            for (i, parts, tree) in walks:
+                entry = self._trees[tree].get(parts[depth])
+                if entry is None:
+                    continue
+
+                (mode, sha) = entry
+                if depth == len(parts) - 1:
+                    exists[i] = mode != TREE_MODE and mode != GITLINK_MODE
+                elif mode == TREE_MODE:
+                    next_walks.append((i, parts, sha))
+
+            walks = next_walks
+            depth += 1
+
+        return exists
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+
+
+_blob_readers = {}
+
+
+def get_blob_reader(project: Path) -> BlobReader:
+    # Keyed by pid too so forked workers never share a parent's pipe
+    key = (os.getpid(), Path(project).resolve())
+    if key not in _blob_readers:
+        _blob_readers[key] = BlobReader(project)
+
+    return _blob_readers[key]
+
+
+CACHE_DIR = Path("cache")
+
+
+def hash_blob(data: bytes) -> str:
+    "The id git gives data when stored as a blob"
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def get_head(project: Path) -> str:
+    proc = subprocess.run(["git", "rev-parse", "HEAD"],
+                          cwd=project, stdout=subprocess.PIPE)
+
+    return proc.stdout.decode("utf-8").strip()
+
+
+class CommitIndex:
+    "Position of every commit in the order given by get_all_commits"
+
+    def __init__(self, head: str, commits: List[str]):
+        self.head = head
+        self.commits = commits
+        self._positions = {commit: i for (i, commit) in enumerate(commits)}
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.commits)
+
+    def __iter__(self):
+        return iter(self.commits)
+
+    def __contains__(self, commit: str):
+        try:
+            self.position(commit)
+            return True
+        except KeyError:
+            return False
+
+    def position(self, commit: str) -> int:
+        "Position of a full or unambiguous short sha"
+        position = self._positions.get(commit)
+        if position is not None:
+            return position
+
+        if self._sorted is None:
+            self._sorted = sorted(self.commits)
+
+        i = bisect.bisect_left(self._sorted, commit)
+        matches = self._sorted[i:i+2]
+        if len(matches) == 0 or not matches[0].startswith(commit) or \
+                (len(matches) == 2 and matches[1].startswith(commit)):
+            raise KeyError(commit)
+
+        return self._positions[matches[0]]
+
+    def __getitem__(self, commit: str) -> int:
+        return self.position(commit)
+
+    def between(self, pre_commit: str, post_commit: str) -> List[str]:
+        "Commits strictly after pre_commit and before post_commit"
+        return self.commits[self.position(pre_commit)+1:self.position(post_commit)]
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            f.write("\n".join([self.head, *self.commits]))
+
+    @classmethod
+    def load(cls, path: Path):
+        with open(path) as f:
+            head, *commits = f.read().split("\n")
+
+        return cls(head, commits)
+
+
+_commit_indexes = {}
+
+
+def get_commit_index(project: Path) -> CommitIndex:
+    "The commit index for project, only running git log again when HEAD has moved"
+    if project in _commit_indexes:
+        return _commit_indexes[project]
+
+    path = CACHE_DIR / project.name / "commits"
+    head = get_head(project)
+
+    index = None
+    if path.is_file():
+        index = CommitIndex.load(path)
+        if index.head != head:
+            index = None
+
+    if index is None:
+        index = CommitIndex(head, get_all_commits(project))
+        index.save(path)
+
+    _commit_indexes[project] = index
+    return index
+
+
+class CommitTreeIndex:
+    """
+    The files changed by every commit relative to its first parent, read from
+    one git log. Answers which files exist in a commit and which changed
+    between two commits without running git again.
+    """
+
+    SNAPSHOTS = 8
+    VERSION = 2
+
+    def __init__(self, head: str, paths: List[str], commits: dict):
+        self.head = head
+        self._paths = paths
+        # sha -> (first parent, statuses, path ids, old and new modes and blob ids)
+        # with 48 bytes per change, a mode of 0 meaning the path doesn't exist
+        self._commits = commits
+        self._snapshots = {}
+
+    @classmethod
+    def build(cls, project: Path):
+        proc = subprocess.run(["git", "-c", "core.quotePath=false", "log",
+                               "--reverse", "--topo-order", "--root", "--raw",
+                               "--no-renames", "--no-abbrev", "--diff-merges=first-parent",
+                               "--format=commit %H %P"],
+                              cwd=project, stdout=subprocess.PIPE)
+
+        path_ids = {}
+        paths = []
+        commits = {}
+
+        def add_commit(commit, parent, statuses, ids, blobs):
+            if commit is not None:
+                commits[commit] = (parent, bytes(statuses), ids, bytes(blobs))
+
+        commit = parent = None
+        statuses, ids, blobs = bytearray(), array("I"), bytearray()
+        for line in proc.stdout.decode("utf-8").split("\n"):
+            if line.startswith("commit "):
+                add_commit(commit, parent, statuses, ids, blobs)
+
+                shas = line.split(" ")
+                commit = shas[1]
+                parent = shas[2] if len(shas) > 2 else None
+                statuses, ids, blobs = bytearray(), array("I"), bytearray()
+            elif line.startswith(":"):
+                # ":<old mode> <new mode> <old blob> <new blob> <status>\t<path>"
+                info, path = line.split("\t", 1)
+                if path not in path_ids:
+                    path_ids[path] = len(paths)
+                    paths.append(path)
+
+                (old_mode, new_mode, old_blob, new_blob, status) = info.split(" ")
+                statuses.append(ord(status[0]))
+                ids.append(path_ids[path])
+                blobs += int(old_mode[1:], 8).to_bytes(4, "big") + bytes.fromhex(old_blob)
+                blobs += int(new_mode, 8).to_bytes(4, "big") + bytes.fromhex(new_blob)
+
+        add_commit(commit, parent, statuses, ids, blobs)
+
+        return cls(get_head(project), paths, commits)
+
+    def __contains__(self, commit: str):
+        return commit in self._commits
+
+    def _first_parents(self, commit: str):
+        while commit is not None and commit in self._commits:
+            yield commit
+            commit = self._commits[commit][0]
+
+    def files_in_commit(self, commit: str) -> set:
+        if commit in self._snapshots:
+            return set(self._snapshots[commit])
+
+        # Walk back to the nearest commit we have the files of, then replay
+        chain = []
+        files = set()
+        for ancestor in self._first_parents(commit):
+            if ancestor in self._snapshots:
+                files = set(self._snapshots[ancestor])
+                break
+            chain.append(ancestor)
+
+        for ancestor in reversed(chain):
+            (_, statuses, ids, _) = self._commits[ancestor]
+            for (status, i) in zip(statuses, ids):
+                if status == ord("A"):
+                    files.add(self._paths[i])
+                elif status == ord("D"):
+                    files.discard(self._paths[i])
+
+        if len(self._snapshots) >= self.SNAPSHOTS:
+            del self._snapshots[next(iter(self._snapshots))]
+        self._snapshots[commit] = frozenset(files)
+
+        return files
+
+    def changed_files(self, pre_commit: str, post_commit: str) -> Optional[set]:
+        """
+        The files git diff --name-only gives between pre_commit and
+        post_commit, or None if pre_commit isn't a first parent ancestor of
+        post_commit or files were both added and removed between them.
+        """
+        # Walking back from post_commit the first change to a path gives its
+        # mode and blob at post_commit and the last change those at pre_commit
+        post_blobs = {}
+        pre_blobs = {}
+        for commit in self._first_parents(post_commit):
+            if commit == pre_commit:
+                changed = [i for (i, blob) in post_blobs.items() if blob != pre_blobs[i]]
+
+                # git diff pairs removed files with similar added ones as
+                # renames and only names the new path, which needs the contents
+                removed = any(post_blobs[i][:4] == bytes(4) for i in changed)
+                added = any(pre_blobs[i][:4] == bytes(4) for i in changed)
+                if removed and added:
+                    return None
+
+                return set(self._paths[i] for i in changed)
+
+            (_, _, ids, blobs) = self._commits[commit]
+            for (change, i) in enumerate(ids):
+                post_blobs.setdefault(i, blobs[change*48+24:change*48+48])
+                pre_blobs[i] = blobs[change*48:change*48+24]
+
+        return None
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump((self.VERSION, self.head, self._paths, self._commits), f)
+
+    @classmethod
+    def load(cls, path: Path):
+        "The saved index, or None if it was saved in an older format"
+        with open(path, "rb") as f:
+            (version, *fields) = pickle.load(f)
+
+        return cls(*fields) if version == cls.VERSION else None
+
+
+_tree_indexes = {}
+
+
+def get_commit_tree_index(project: Path) -> CommitTreeIndex:
+    "The tree index for project, rebuilt only when its HEAD has moved"
+    if project in _tree_indexes:
+        return _tree_indexes[project]
+
+    path = CACHE_DIR / project.name / "trees.pickle"
+    index = None
+    if path.is_file():
+        index = CommitTreeIndex.load(path)
+        if index is not None and index.head != get_head(project):
+            index = None
+
+    if index is None:
+        index = CommitTreeIndex.build(project)
+        index.save(path)
+
+    _tree_indexes[project] = index
+    return index
+
+
 def load_file(project: Path, commit: str, file: str):
-    proc = subprocess.run(["git", "show", commit + ":" + str(file)],
-                          cwd=project, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return get_blob_reader(project).load_files([(commit, file)])[0]
+
+
+def load_files(project: Path, requests: List[Tuple[str, str]]):
+    "Loads every (commit, file) in requests through a single git process"
+    return get_blob_reader(project).load_files(requests)
 
-    src = proc.stdout.decode("utf-8")
-    if f"'{commit}'" in src:
-        return "Does not exist", False
-    else:
-        return src, True
+
+def files_exist(project: Path, commit: str, files: List[str]) -> List[bool]:
+    "Whether each of files exists at commit, without touching the working tree"
+    return get_blob_reader(project).files_exist(commit, files)
 
 
 def init(project: Path):
@@ -79,18 +506,10 @@ def init(project: Path):
     subprocess.run(["git", "init"], cwd=project, stdout=subprocess.PIPE)
 
 
-extract_commit_re = re.compile(r" (\w+)\]")
-
-
 def commit_all(project: Path):
     subprocess.run(["git", "add", "-A"], cwd=project, stdout=subprocess.PIPE)
 
-    proc = subprocess.run(
-        ["git", "commit", "-m", "'commit'"], cwd=project, stdout=subprocess.PIPE)
-    commit_match = re.search(extract_commit_re, proc.stdout.decode("utf-8"))
-    short_commit = commit_match.group(1)
+    subprocess.run(["git", "commit", "-m", "'commit'"],
+                   cwd=project, stdout=subprocess.PIPE)
 
-    all_commits = get_all_commits(project)
-    
-    return next(commit for commit in all_commits
-                if commit.startswith(short_commit))
+    return get_head(project)
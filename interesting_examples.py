@@ -8,22 +8,15 @@ from diag_utils import DiagnosticsDiff
 from pathlib import Path
 from matchhelper2 import FileLoader
 from meyersdiff import *
-from functools import lru_cache
+from diff_cache import load_line_map
 
 
-@lru_cache
 def load_diff(old_src, new_src):
-    return myers_diff(old_src.split("\n"), new_src.split("\n"))
+    return load_line_map(old_src, new_src)
 
 
-def on_deleted_line(src_diff, line):
-    old_line = 0
-    for line_diff in src_diff:
-        if isinstance(line_diff, Keep) or isinstance(line_diff, Remove):
-            old_line += 1
-
-        if old_line == line:
-            return isinstance(line_diff, Remove)
+def on_deleted_line(line_map, line):
+    return line_map.is_deleted(line)
 
 
 def get_interesting_diags(project, diff, changed_diags):
@@ -34,9 +27,11 @@ def get_interesting_diags(project, diff, changed_diags):
     files = set((d._file for (d, _) in changed_diags))
     print(len(files)*2)
 
+    requests = []
     for (old, new) in changed_diags:
-        f.load(old._file, diff.pre_commit)
-        f.load(new._file, diff.post_commit)
+        requests.append((old._file, diff.pre_commit))
+        requests.append((new._file, diff.post_commit))
+    f.load_many(requests)
     print("Formatting files")
     f.format_files()
 
@@ -0,0 +1,256 @@
+import atexit
+import heapq
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from githelpers import hash_blob
+
+# Tools are run from the folder holding google-format.jar, as FileLoader always has
+JAR = Path("google-format.jar")
+SERVER = Path(__file__).parent / "FormatServer.java"
+STORE_DIR = Path("cache") / "formatted"
+CLI_FLAGS = ["--skip-sorting-imports", "--skip-removing-unused-imports"]
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# google-java-format reaches into javac internals, which the jar's manifest
+# opens up when run with -jar but have to be given explicitly on a classpath
+JAVAC_EXPORTS = [
+    f"--add-exports=jdk.compiler/com.sun.tools.javac.{package}=ALL-UNNAMED"
+    for package in ["api", "code", "file", "parser", "tree", "util"]
+]
+
+
+def format_with_cli(src: bytes, jar: Path = JAR) -> Tuple[bytes, bool]:
+    "Formats src with a JVM of its own, as format does"
+    task = subprocess.run(["java", "-jar", str(jar), "-", *CLI_FLAGS],
+                          input=src, stdout=subprocess.PIPE)
+
+    return (task.stdout, True) if task.returncode == 0 else (src, False)
+
+
+class FormatterProcess:
+    """A long running google-java-format, fed sources over stdin and stdout.
+
+    If FormatServer won't start, say with a jar too old for it, or dies,
+    sources are formatted with a JVM each instead"""
+
+    def __init__(self, jar: Path = JAR):
+        self._jar = jar
+        self._proc = subprocess.Popen(["java", *JAVAC_EXPORTS, "-cp", str(jar), str(SERVER)],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _request(self, src: bytes) -> Optional[Tuple[bytes, bool]]:
+        try:
+            self._proc.stdin.write(struct.pack(">i", len(src)) + src)
+            self._proc.stdin.flush()
+
+            header = self._proc.stdout.read(8)
+            if len(header) != 8:
+                return None
+
+            (status, length) = struct.unpack(">ii", header)
+            formatted = self._proc.stdout.read(length)
+        except OSError:
+            return None
+
+        return (formatted, status == 0) if len(formatted) == length else None
+
+    def format(self, src: bytes) -> Tuple[bytes, bool]:
+        "src formatted and True, or src unchanged and False if google-java-format failed"
+        if self._proc is not None:
+            response = self._request(src)
+            if response is not None:
+                return response
+
+            print("FormatServer stopped, formatting with a JVM per file instead", file=sys.stderr)
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+
+        return format_with_cli(src, self._jar)
+
+    def close(self):
+        if self._proc is None:
+            return
+
+        self._proc.stdin.close()
+        self._proc.wait()
+
+
+class FormattedStore:
+    "Formatted sources on disk keyed by the blob id of the unformatted source"
+
+    def __init__(self, folder: Path = STORE_DIR):
+        self._folder = folder
+
+    def _path(self, blob: str) -> Path:
+        return self._folder / blob[:2] / blob
+
+    def get(self, blob: str) -> Optional[bytes]:
+        try:
+            with open(self._path(blob), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, blob: str, formatted: bytes):
+        path = self._path(blob)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp = path.with_name(path.name + f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(formatted)
+        tmp.replace(path)
+
+
+_formatters: List[FormatterProcess] = []
+_store = FormattedStore()
+
+
+def _close_formatters():
+    for formatter in _formatters:
+        formatter.close()
+
+
+atexit.register(_close_formatters)
+
+
+def get_formatters(n: int) -> List[FormatterProcess]:
+    "n resident formatters, started the first time they are asked for"
+    while len(_formatters) < n:
+        _formatters.append(FormatterProcess())
+
+    return _formatters[:n]
+
+
+def get_formatter() -> FormatterProcess:
+    return get_formatters(1)[0]
+
+
+def format_source(src: bytes, formatter: FormatterProcess = None) -> bytes:
+    """
+    Formats src, only running google-java-format the first time src is seen.
+    src is returned unchanged if it fails, and tried again next time.
+    """
+    blob = hash_blob(src)
+
+    formatted = _store.get(blob)
+    if formatted is None:
+        (formatted, ok) = (formatter or get_formatter()).format(src)
+        if ok:
+            _store.put(blob, formatted)
+
+    return formatted
+
+
+def _write_if_changed(file: Path, src: bytes, formatted: bytes):
+    if formatted != src:
+        with open(file, "wb") as f:
+            f.write(formatted)
+
+
+def shard_by_size(sizes: Dict[str, int], n: int) -> List[List[str]]:
+    "Splits the keys of sizes into n shards of roughly equal total size, largest first"
+    shards = [[] for _ in range(n)]
+    totals = [(0, i) for i in range(n)]
+
+    for key in sorted(sizes, key=lambda key: sizes[key], reverse=True):
+        (total, i) = heapq.heappop(totals)
+        shards[i].append(key)
+        heapq.heappush(totals, (total + sizes[key], i))
+
+    return [shard for shard in shards if shard]
+
+
+class Progress:
+    "Prints how far through formatting we are at most once a second"
+
+    def __init__(self, total_files: int, total_bytes: int):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self._start = time.time()
+        self._last_print = 0
+        self._lock = threading.Lock()
+
+    def update(self, files: int, size: int):
+        with self._lock:
+            self.files += files
+            self.bytes += size
+
+            now = time.time()
+            if now - self._last_print >= 1 or self.files == self.total_files:
+                self._last_print = now
+                self.print(now)
+
+    def print(self, now: float):
+        elapsed = max(now - self._start, 1e-9)
+        print(f"Formatted {self.files}/{self.total_files} files "
+              f"({self.bytes // 1024}/{self.total_bytes // 1024} KB) "
+              f"{self.files / elapsed:.1f} files/s {self.bytes / elapsed / 1024:.1f} KB/s")
+
+
+def format_files(files: List[Path], workers: int = None):
+    """
+    Formats files in place like google-java-format -i. Sources that have
+    not been formatted before are split across workers formatters by size.
+    """
+    if workers is None:
+        workers = DEFAULT_WORKERS
+
+    # Files with identical sources are only formatted once
+    pending: Dict[str, List[Path]] = {}
+    sizes: Dict[str, int] = {}
+    for file in files:
+        with open(file, "rb") as f:
+            src = f.read()
+
+        blob = hash_blob(src)
+        formatted = _store.get(blob)
+        if formatted is not None:
+            _write_if_changed(file, src, formatted)
+        elif blob in pending:
+            pending[blob].append(file)
+        else:
+            pending[blob] = [file]
+            sizes[blob] = len(src)
+
+    if len(pending) == 0:
+        return
+
+    shards = shard_by_size(sizes, workers)
+    progress = Progress(sum(len(same) for same in pending.values()), sum(sizes.values()))
+
+    def format_shard(formatter: FormatterProcess, shard: List[str]):
+        for blob in shard:
+            with open(pending[blob][0], "rb") as f:
+                src = f.read()
+
+            # Files google-java-format fails on are left as they are, like -i does
+            (formatted, ok) = formatter.format(src)
+            if ok:
+                _store.put(blob, formatted)
+                for file in pending[blob]:
+                    _write_if_changed(file, src, formatted)
+
+            progress.update(len(pending[blob]), len(src))
+
+    formatters = get_formatters(len(shards))
+    if len(shards) == 1:
+        format_shard(formatters[0], shards[0])
+        return
+
+    # The formatting happens in the JVMs, so threads are enough to keep them all busy
+    with ThreadPoolExecutor(len(shards)) as pool:
+        for result in [pool.submit(format_shard, formatter, shard)
+                       for (formatter, shard) in zip(formatters, shards)]:
+            result.result()
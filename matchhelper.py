@@ -2,10 +2,14 @@
 import sys
 import os
 import random
+import time
 
 from pathlib import Path
+from typing import List
 
+from analysis_state import AnalysisState
 from diag_utils import DiagnosticsDiff, Diagnostic
+from sampling import StratifiedReservoir, pop_options, stratify_by
 
 
 def inplace_filter(diff: DiagnosticsDiff):
@@ -14,11 +18,27 @@ def inplace_filter(diff: DiagnosticsDiff):
                     if old != new}
 
 
-def inplace_strat(diff: DiagnosticsDiff, num: int):
-    diff.matches = {old: new
-                    for (old, new) in strat(list(diff.matches.items()), num)}
-    diff.unmatched_old = strat(diff.unmatched_old, num)
-    diff.unmatched_new = strat(diff.unmatched_new, num)
+def inplace_strat(diff: DiagnosticsDiff, num: int, seed: int = None, by: str = None, skip_exact: bool = False):
+    """
+    Samples 1 in num of each section of diff, streaming it from file. Each
+    section is seeded from seed and its diff, so a diff's sample doesn't depend
+    on which others were sampled. skip_exact leaves out matches to an equal
+    diagnostic, as inplace_filter does.
+    """
+    def section_seed(section):
+        return None if seed is None else f"{seed} {diff.file.name} {section}"
+
+    matches = diff.iter_matches()
+    if skip_exact:
+        matches = ((old, new) for (old, new) in matches if old != new)
+
+    # The header totals bound every section, so they size the reservoirs
+    diff.matches = dict(strat(matches, num, section_seed("matches"),
+                              stratify_by(by, lambda match: match[0]), diff.num_matches // num))
+    diff.unmatched_old = strat(diff.iter_unmatched_old(), num, section_seed("unmatched old"),
+                               stratify_by(by), diff.num_unmatched_old // num)
+    diff.unmatched_new = strat(diff.iter_unmatched_new(), num, section_seed("unmatched new"),
+                               stratify_by(by), diff.num_unmatched_new // num)
 
 
 def filter_exact_matches(file: Path):
@@ -31,27 +51,32 @@ def filter_exact_matches(file: Path):
     diff.write(file.with_suffix(".filtered"))
 
 
-def strat(items, factor):
-    random.shuffle(items)
-    return random.sample(items, k=len(items)//factor)
+def strat(items, factor, seed: int = None, key=None, k: int = None):
+    "A random 1 in factor of items, k being at least that many when items is a stream"
+    if k is None:
+        items = list(items)
+        k = len(items) // factor
 
+    reservoir = StratifiedReservoir(k, key, seed)
+    reservoir.extend(items)
+    return reservoir.sample(reservoir.seen // factor)
 
-def stratify_findings(file: Path, num: int):
+
+def stratify_findings(file: Path, num: int, seed: int = None, by: str = None):
     if not file.exists():
         raise Exception(file + " does not exist")
 
     diff = DiagnosticsDiff(file)
-    inplace_strat(diff, num)
+    inplace_strat(diff, num, seed, by)
     diff.write(file.with_suffix(".strat"))
 
 
-def strat_filter(file: Path, num: int):
+def strat_filter(file: Path, num: int, seed: int = None, by: str = None):
     if not file.exists():
         raise Exception(file + " does not exist")
 
     diff = DiagnosticsDiff(file)
-    inplace_filter(diff)
-    inplace_strat(diff, num)
+    inplace_strat(diff, num, seed, by, skip_exact=True)
     diff.write(file.with_suffix(".strat_filtered"))
 
 
@@ -80,23 +105,93 @@ def remove_overlapping_matches(diff, diff2):
                      if old not in dup_keys}
 
 
-def gen_pr_file(dirr: Path, num: int):
+def remove_duplicate_matches(diffs: List[DiagnosticsDiff]):
+    """
+    Keeps each match only in the first diff it is found in and any other diff
+    between the same commits, as remove_overlapping_matches over every pair
+    of diffs would, but in one pass
+    """
+    owners = {}
+    for diff in diffs:
+        owner = (diff.pre, diff.post)
+        diff.matches = {old: new
+                        for (old, new) in diff.matches.items()
+                        if owners.setdefault((old, new), owner) == owner}
+
+
+def synthetic_diffs(n: int, matches_per_diff: int = 20, seed: int = 0) -> List[DiagnosticsDiff]:
+    "n diffs whose matches often repeat, some between the same commits as the diff before"
+    rng = random.Random(seed)
+    pool = [Diagnostic.from_fields(f"src/File{i % 97}.java", i, 1, i * 10, i * 10 + 1, i * 10 + 5,
+                                   ["[Synthetic] message " + str(i)])
+            for i in range(max(1, n * matches_per_diff // 4))]
+
+    diffs = []
+    for i in range(n):
+        pre = i - 1 if i % 50 == 49 else i
+        diff = DiagnosticsDiff(Path(f"{pre} {pre:040x} -> {pre+1} {pre+1:040x}"))
+
+        # Most olds are matched to the same new wherever they appear, some not
+        matches = {}
+        for _ in range(matches_per_diff):
+            old = rng.randrange(len(pool))
+            matches[pool[old]] = pool[(old + (rng.random() < 0.1)) % len(pool)]
+        diff.matches = matches
+
+        diffs.append(diff)
+
+    return diffs
+
+
+def bench_gen_pr(n: int, reference_limit: int = 1000):
+    "Times removing duplicate matches from n synthetic diffs, checked against every pair when n is small"
+    diffs = synthetic_diffs(n)
+    total = sum(len(diff.matches) for diff in diffs)
+
+    start = time.time()
+    remove_duplicate_matches(diffs)
+    print(f"One pass over {n} diffs with {total} matches: {time.time() - start:.3f}s, "
+          f"{sum(len(diff.matches) for diff in diffs)} kept")
+
+    if n > reference_limit:
+        return
+
+    reference = synthetic_diffs(n)
+    start = time.time()
+    for diff in reference:
+        for other in reference:
+            if other == diff:
+                continue
+
+            remove_overlapping_matches(diff, other)
+    print(f"Every pair: {time.time() - start:.3f}s")
+
+    if any(list(diff.matches.items()) != list(expected.matches.items())
+           for (diff, expected) in zip(diffs, reference)):
+        raise Exception("one pass and every pair disagree")
+
+
+def gen_pr_file(dirr: Path, num: int, seed: int = None, by: str = None):
     if not dirr.is_dir():
         raise Exception(dirr + " is not a dir")
 
-    # Filter & stratify
+    # Filter & stratify, keeping the samples already drawn for diffs that haven't changed
     diffs = DiagnosticsDiff.load_all(dirr)
-    for diff in diffs:
-        inplace_filter(diff)
-        inplace_strat(diff, num)
+    state = AnalysisState(dirr, "gen_pr")
+
+    def sample(diff):
+        inplace_strat(diff, num, seed, by, skip_exact=True)
+        return (diff.matches, diff.unmatched_old, diff.unmatched_new)
 
-    # Avoid double counting
     for diff in diffs:
-        for other in diffs:
-            if other == diff:
-                continue
+        (diff.matches, diff.unmatched_old, diff.unmatched_new) = state.memo(
+            (diff.file.name, num, seed, by), [diff.file], lambda: sample(diff))
 
-            remove_overlapping_matches(diff, other)
+    state.save()
+    print(state)
+
+    # Avoid double counting
+    remove_duplicate_matches(diffs)
 
     # Write to file
     with open(dirr / "pr_sample", "w") as out:
@@ -119,15 +214,20 @@ def gen_pr_file(dirr: Path, num: int):
 
 
 if __name__ == "__main__":
-    cmd = sys.argv[1]
+    # --seed <n> makes samples reproducible, --by type|file stratifies them
+    (argv, seed, by) = pop_options(sys.argv)
+
+    cmd = argv[1]
     if cmd == "filter":
-        filter_exact_matches(Path(sys.argv[2]))
+        filter_exact_matches(Path(argv[2]))
     elif cmd == "strat":
-        stratify_findings(Path(sys.argv[2]), int(sys.argv[3]))
+        stratify_findings(Path(argv[2]), int(argv[3]), seed, by)
     elif cmd == "strat-filter":
-        strat_filter(Path(sys.argv[2]), int(sys.argv[3]))
+        strat_filter(Path(argv[2]), int(argv[3]), seed, by)
     elif cmd == "gen-pr":
-        gen_pr_file(Path(sys.argv[2]), int(
-            sys.argv[3]) if len(sys.argv) == 4 else 5)
+        gen_pr_file(Path(argv[2]), int(
+            argv[3]) if len(argv) == 4 else 5, seed, by)
+    elif cmd == "bench-gen-pr":
+        bench_gen_pr(int(argv[2]))
     else:
         raise Exception("unknown command " + cmd)
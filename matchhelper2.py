@@ -3,9 +3,9 @@ import sys
 
 from diag_utils import DiagnosticsDiff, Diagnostic
 import githelpers
+import java_formatter
+from sampling import StratifiedReservoir, pop_options, stratify_by
 
-import random
-import subprocess
 from pathlib import Path
 from functools import lru_cache
 
@@ -14,14 +14,19 @@ PROJECT_URLS = {
 }
 
 
-def stratify_diff(diff: DiagnosticsDiff, strat: int):
-    matches = [(old, new)
-               for (old, new) in diff.matches.items()
-               if old != new]
+def stratify_diff(diff: DiagnosticsDiff, strat: int, seed: int = None, by: str = None):
+    "Keeps a random 1 in strat of the matches to a changed diagnostic, streamed from file"
+    matches = ((old, new)
+               for (old, new) in diff.iter_matches()
+               if old != new)
 
-    random.shuffle(matches)
+    # Rounded up like taking every strat'th, the header total bounding how many that can be
+    reservoir = StratifiedReservoir(-(-diff.num_matches // strat),
+                                    stratify_by(by, lambda match: match[0]),
+                                    None if seed is None else f"{seed} {diff.file.name}")
+    reservoir.extend(matches)
 
-    sorted_tuples = sorted(matches[::strat], key=lambda p: p[0]._file)
+    sorted_tuples = sorted(reservoir.sample(-(-reservoir.seen // strat)), key=lambda p: p[0]._file)
     diff.matches = {old: new for (old, new) in sorted_tuples}
 
 
@@ -42,34 +47,25 @@ class FileLoader:
         return
 
     @staticmethod
-    def format(files):
-        if len(files) == 0:
-            return
-
-        def chunks(lst, n):
-            """Yield successive n-sized chunks from lst."""
-            for i in range(0, len(lst), n):
-                yield lst[i:i + n]
-
-        for files_to_format in chunks(files, 500):
-            subprocess.run(["java", "-jar", "google-format.jar", "-i",
-                            "--skip-sorting-imports", "--skip-removing-unused-imports",
-                            *files_to_format])
+    def format(files, workers: int = None):
+        java_formatter.format_files(files, workers)
 
     @staticmethod
     def load_diff(project, diff):
         f = FileLoader(project, Path("dump") / project.name)
 
+        requests = []
         for (old, new) in diff.matches.items():
-            f.load(old._file, diff.pre_commit)
-            f.load(new._file, diff.post_commit)
+            requests.append((old._file, diff.pre_commit))
+            requests.append((new._file, diff.post_commit))
 
         for unmatched_old in diff.unmatched_old:
-            f.load(unmatched_old._file, diff.pre_commit)
+            requests.append((unmatched_old._file, diff.pre_commit))
 
         for unmatched_new in diff.unmatched_new:
-            f.load(unmatched_new._file, diff.post_commit)
+            requests.append((unmatched_new._file, diff.post_commit))
 
+        f.load_many(requests)
         f.format_files()
 
         return f
@@ -80,6 +76,9 @@ class FileLoader:
     def _load_formatted(self, file: Path, commit: str):
         src, loaded = githelpers.load_file(self._project, commit, file)
 
+        return self._write_loaded(file, commit, src, loaded)
+
+    def _write_loaded(self, file: Path, commit: str, src: str, loaded: bool):
         output_file = self._get_file_path(file, commit)
         self._files.append((output_file, loaded))
 
@@ -88,6 +87,20 @@ class FileLoader:
 
         return loaded
 
+    def load_many(self, requests):
+        "Fetches every (file, commit) not already on disk with one batch of git lookups"
+        missing = {}
+        for (file, commit) in requests:
+            file = Path(file)
+            if not self._get_file_path(file, commit).exists():
+                missing[(file, commit)] = True
+
+        loaded_files = githelpers.load_files(self._project,
+                                             [(commit, file) for (file, commit) in missing])
+
+        for ((file, commit), (src, loaded)) in zip(missing, loaded_files):
+            self._write_loaded(file, commit, src, loaded)
+
     def load(self, file: str, commit: str):
         file = Path(file)
 
@@ -113,25 +126,28 @@ class FileLoader:
 def write_touched_files(project: Path, diff: DiagnosticsDiff, output: Path):
     # Step 1 load them onto disk
     f = FileLoader(project, output)
+    requests = []
     for (old, new) in diff.matches.items():
-        f.load(old._file, diff.pre_commit)
-        f.load(new._file, diff.post_commit)
+        requests.append((old._file, diff.pre_commit))
+        requests.append((new._file, diff.post_commit))
 
     for unmatched_old in diff.unmatched_old:
-        f.load(unmatched_old._file, diff.pre_commit)
-        f.load(unmatched_old._file, diff.post_commit)
+        requests.append((unmatched_old._file, diff.pre_commit))
+        requests.append((unmatched_old._file, diff.post_commit))
 
     for unmatched_new in diff.unmatched_new:
-        f.load(unmatched_new._file, diff.pre_commit)
-        f.load(unmatched_new._file, diff.post_commit)
+        requests.append((unmatched_new._file, diff.pre_commit))
+        requests.append((unmatched_new._file, diff.post_commit))
+
+    f.load_many(requests)
 
     return f.formattable_files
 
 
-def gen_check_file(project: Path, diffs_folder: Path, strat: int):
+def gen_check_file(project: Path, diffs_folder: Path, strat: int, seed: int = None, by: str = None):
     diffs = DiagnosticsDiff.load_all(diffs_folder)
     for diff in diffs:
-        stratify_diff(diff, strat)
+        stratify_diff(diff, strat, seed, by)
 
     print("Going to check " + str(sum((len(diff.matches) for diff in diffs))))
 
@@ -146,4 +162,6 @@ def gen_check_file(project: Path, diffs_folder: Path, strat: int):
 
 
 if __name__ == "__main__":
-    gen_check_file(Path(sys.argv[1]), Path(sys.argv[2]), int(sys.argv[3]))
+    # --seed <n> makes the sample reproducible, --by type|file stratifies it
+    (argv, seed, by) = pop_options(sys.argv)
+    gen_check_file(Path(argv[1]), Path(argv[2]), int(argv[3]), seed, by)
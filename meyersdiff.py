@@ -24,8 +24,11 @@
 # For more information, please refer to <http://unlicense.org/> 
 
 # from __future__ import print_function # Py2 compat
+from array import array
 from collections import namedtuple
+from pathlib import Path
 import sys
+import time
 
 # These define the structure of the history, and correspond to diff output with
 # lines that start with a space, a + and a - respectively.
@@ -33,21 +36,246 @@ Keep = namedtuple('Keep', ['line'])
 Insert = namedtuple('Insert', ['line'])
 Remove = namedtuple('Remove', ['line'])
 
-# See frontier in myers_diff
+# A run of the same edit, as 0-based [start, end) ranges of old and new lines.
+# Inserts have an empty old range and removes an empty new range.
+Hunk = namedtuple('Hunk', ['op', 'old_start', 'old_end', 'new_start', 'new_end'])
+
+# See frontier in _reference_myers_diff
 Frontier = namedtuple('Frontier', ['x', 'history'])
 
-def myers_diff(a_lines, b_lines):
-    if type(a_lines) is str:
-        a_lines = a_lines.split("\n")
+# Edit scripts are built as runs of (op, old index, new index, length)
+KEEP = 0
+INSERT = 1
+REMOVE = 2
 
-    if type(b_lines) is str:
-        b_lines = b_lines.split("\n")
 
+def _split_lines(lines):
+    if type(lines) is str:
+        return lines.split("\n")
+    return lines
+
+
+def _hash_lines(a_lines, b_lines):
+    "Swaps every line for a small int so comparing lines is an int compare"
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a_lines]
+    b = [ids.setdefault(line, len(ids)) for line in b_lines]
+    return a, b
+
+
+def _add_run(runs, op, a_index, b_index, length):
+    if length == 0:
+        return
+
+    if runs:
+        (last_op, last_a, last_b, last_length) = runs[-1]
+        if last_op == op and \
+                (op == INSERT or last_a + last_length == a_index) and \
+                (op == REMOVE or last_b + last_length == b_index):
+            runs[-1] = (op, last_a, last_b, last_length + length)
+            return
+
+    runs.append((op, a_index, b_index, length))
+
+
+def _myers_trace(a, b):
+    """
+    The same greedy search as _reference_myers_diff, but only the furthest x
+    on each diagonal is kept for every d rather than a copy of the history.
+    Returns those frontiers along with the d and k the search finished on.
+    """
+    a_max = len(a)
+    b_max = len(b)
+    offset = a_max + b_max + 1
+
+    frontier = [0] * (2 * offset + 1)
+    trace = []
+
+    for d in range(0, a_max + b_max + 1):
+        # Frontier before step d, covering diagonals -d-1..d+1
+        trace.append(frontier[offset - d - 1:offset + d + 2])
+
+        for k in range(-d, d + 1, 2):
+            go_down = (k == -d or
+                       (k != d and frontier[offset + k - 1] < frontier[offset + k + 1]))
+
+            if go_down:
+                x = frontier[offset + k + 1]
+            else:
+                x = frontier[offset + k - 1] + 1
+
+            y = x - k
+            while x < a_max and y < b_max and a[x] == b[y]:
+                x += 1
+                y += 1
+
+            if x >= a_max and y >= b_max:
+                return trace, d, k, x
+
+            frontier[offset + k] = x
+
+    assert False, 'Could not find edit script'
+
+
+def _myers_runs(a, b):
+    "Edit script for two lists of hashed lines as runs of (op, a index, b index, length)"
+    a_max = len(a)
+    b_max = len(b)
+
+    trace, d, k, x_end = _myers_trace(a, b)
+
+    # Walk the trace backwards, recovering the move and snake made at each d
+    steps = []
+    for d in range(d, -1, -1):
+        before = trace[d]
+
+        def x_at(k):
+            return before[k + d + 1]
+
+        go_down = k == -d or (k != d and x_at(k - 1) < x_at(k + 1))
+        x_mid = x_at(k + 1) if go_down else x_at(k - 1) + 1
+
+        steps.append((go_down, x_mid, x_mid - k, x_end - x_mid))
+
+        k = k + 1 if go_down else k - 1
+        x_end = x_at(k)
+
+    runs = []
+    for (go_down, x, y, snake) in reversed(steps):
+        # We start at the invalid point (0, 0) - we should only start building
+        # up history when we move off of it.
+        if 1 <= y <= b_max and go_down:
+            _add_run(runs, INSERT, x, y - 1, 1)
+        elif 1 <= x <= a_max:
+            _add_run(runs, REMOVE, x - 1, y, 1)
+
+        _add_run(runs, KEEP, x, y, snake)
+
+    return runs
+
+
+def myers_runs(a_lines, b_lines):
+    """
+    The edit script of myers_diff as runs of (op, old index, new index, length)
+    with op one of KEEP, INSERT or REMOVE and indices 0-based.
+    """
+    a, b = _hash_lines(_split_lines(a_lines), _split_lines(b_lines))
+
+    # A common prefix is always one free snake from (0, 0), so it can be
+    # skipped without changing the script. A common suffix can't, as the
+    # search could have lined it up differently.
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+
+    runs = []
+    _add_run(runs, KEEP, 0, 0, prefix)
+    for (op, a_index, b_index, length) in _myers_runs(a[prefix:], b[prefix:]):
+        _add_run(runs, op, a_index + prefix, b_index + prefix, length)
+
+    return runs
+
+
+def myers_hunks(a_lines, b_lines):
+    "The edit script of myers_diff as Hunks"
+    hunks = []
+    for (op, a_index, b_index, length) in myers_runs(a_lines, b_lines):
+        if op == KEEP:
+            hunks.append(Hunk(op, a_index, a_index + length, b_index, b_index + length))
+        elif op == INSERT:
+            hunks.append(Hunk(op, a_index, a_index, b_index, b_index + length))
+        else:
+            hunks.append(Hunk(op, a_index, a_index + length, b_index, b_index))
+
+    return hunks
+
+
+class LineMap:
+    """
+    Precomputed answers to line queries about an edit script. Lines are
+    1-based, as they are in diagnostics and the editor.
+    """
+
+    def __init__(self, hunks):
+        num_old_lines = hunks[-1].old_end if hunks else 0
+
+        # closest[line] is the new line an old line was kept as, or for a
+        # removed line the last new line before it
+        self._closest = array('i', bytes(4 * (num_old_lines + 1)))
+        self._deleted = bytearray(num_old_lines + 1)
+
+        for hunk in hunks:
+            for old_line in range(hunk.old_start + 1, hunk.old_end + 1):
+                if hunk.op == KEEP:
+                    self._closest[old_line] = hunk.new_start + old_line - hunk.old_start
+                else:
+                    self._closest[old_line] = hunk.new_start
+                    self._deleted[old_line] = 1
+
+    @classmethod
+    def diff(cls, a_lines, b_lines):
+        return cls(myers_hunks(a_lines, b_lines))
+
+    def _in_range(self, line):
+        return 1 <= line < len(self._deleted)
+
+    def is_deleted(self, line):
+        "Was the old line removed, or None if there is no such line"
+        if not self._in_range(line):
+            return None
+        return self._deleted[line] == 1
+
+    def new_line(self, line):
+        "The new line an old line was kept as, or None if it was removed"
+        if not self._in_range(line) or self._deleted[line]:
+            return None
+        return self._closest[line]
+
+    def closest_new_line(self, line):
+        "Like new_line, but falls back to the new line just before a removed line"
+        if not self._in_range(line):
+            return None
+        return self._closest[line]
+
+
+def myers_diff(a_lines, b_lines, hunks=False):
     """
     An implementation of the Myers diff algorithm.
 
     See http://www.xmailserver.org/diff2.pdf
+
+    Pass hunks=True for the script as runs of Hunks rather than one entry
+    per line.
+    """
+    if hunks:
+        return myers_hunks(a_lines, b_lines)
+
+    a_lines = _split_lines(a_lines)
+    b_lines = _split_lines(b_lines)
+
+    history = []
+    for (op, a_index, b_index, length) in myers_runs(a_lines, b_lines):
+        if op == KEEP:
+            history.extend(Keep(line) for line in a_lines[a_index:a_index + length])
+        elif op == INSERT:
+            history.extend(Insert(line) for line in b_lines[b_index:b_index + length])
+        else:
+            history.extend(Remove(line) for line in a_lines[a_index:a_index + length])
+
+    return history
+
+
+def _reference_myers_diff(a_lines, b_lines):
+    """
+    The original implementation, which copies the history along every
+    diagonal. Kept to check and benchmark myers_diff against.
     """
+    if type(a_lines) is str:
+        a_lines = a_lines.split("\n")
+
+    if type(b_lines) is str:
+        b_lines = b_lines.split("\n")
+
     # This marks the farthest-right point along each diagonal in the edit
     # graph, along with the history that got it there
     frontier = {1: Frontier(0, [])}
@@ -116,6 +344,50 @@ def myers_diff(a_lines, b_lines):
 
     assert False, 'Could not find edit script'
 
+def _check(files):
+    """
+    Diffs each consecutive pair of files with both implementations, failing
+    if their edit scripts differ and printing how long each took.
+    """
+    total_reference = 0
+    total = 0
+    for (old_file, new_file) in zip(files, files[1:]):
+        with open(old_file) as a_handle:
+            a_lines = [line.rstrip() for line in a_handle]
+
+        with open(new_file) as b_handle:
+            b_lines = [line.rstrip() for line in b_handle]
+
+        start = time.perf_counter()
+        reference = _reference_myers_diff(a_lines, b_lines)
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        diff = myers_diff(a_lines, b_lines)
+        diff_time = time.perf_counter() - start
+
+        if diff != reference:
+            raise Exception(f"Edit scripts differ for {old_file} -> {new_file}")
+
+        print(f"{old_file} -> {new_file}: {len(a_lines)} -> {len(b_lines)} lines, "
+              f"reference {reference_time:.3f}s, myers_diff {diff_time:.3f}s")
+
+        total_reference += reference_time
+        total += diff_time
+
+    print(f"Total reference {total_reference:.3f}s, myers_diff {total:.3f}s")
+
+
+if __name__ == "__main__":
+    # check <folder> | check <file> <file> ...
+    if sys.argv[1] == "check":
+        paths = [Path(path) for path in sys.argv[2:]]
+        if len(paths) == 1 and paths[0].is_dir():
+            paths = sorted(path for path in paths[0].iterdir() if path.is_file())
+        _check(paths)
+    else:
+        raise Exception("unknown command " + sys.argv[1])
+
 # def main():
 #     try:
 #         _, a_file, b_file = sys.argv
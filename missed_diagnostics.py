@@ -9,17 +9,18 @@ from typing import List
 
 import githelpers
 
-from diag_utils import Diagnostic, DiagnosticsDiff, DiagnosticsFile, find_when_leaves
+from analysis_state import AnalysisState
+from diag_utils import Diagnostic, DiagnosticsDiff, DiagnosticsFile, DiffTimeline, LineageIndex
 
 
 def merge_diagnostics(project: Path,
                       lr_diags: List[DiagnosticsFile],
                       hr_diags: List[DiagnosticsFile]) -> List[DiagnosticsFile]:
     "Merge the low and high resolution respecting ordering of all_commits"
-    all_commits = githelpers.get_all_commits(project)
+    commit_index = githelpers.get_commit_index(project)
 
     def find_global_seq(diag):
-        return all_commits.index(diag.commit)
+        return commit_index.position(diag.commit)
 
     merged_unsorted = list(set([*lr_diags, *hr_diags]))
 
@@ -33,9 +34,9 @@ def consecutive_pairs(items):
         yield (items[i], items[i+1])
 
 
-def find_commits_between(all_commits, lr_pre, lr_post):
-    i1 = all_commits.index(lr_pre)
-    i2 = all_commits.index(lr_post)
+def find_commits_between(all_commits, positions, lr_pre, lr_post):
+    i1 = positions[lr_pre.commit]
+    i2 = positions[lr_post.commit]
 
     if i1 == i2:
         return []
@@ -43,87 +44,108 @@ def find_commits_between(all_commits, lr_pre, lr_post):
     return all_commits[i1+1:i2]
 
 
-def get_diff(diffs: List[DiagnosticsDiff], pre_commit: str, post_commit: str):
-    return next((diff for diff in diffs
-                 if diff.pre_commit == pre_commit and diff.post_commit == post_commit))
+def guess_if_compilation_failed(diags, positions, diag, commit):
+    i = positions[commit]
 
+    if diag in diags[i].diagnostic_set:
+        return False
 
-def get_diffs(diffs: List[DiagnosticsDiff], pre_commit: str, post_commit: str):
-    start_diff = next(i for (i, diff) in enumerate(diffs)
-                      if diff.pre_commit == pre_commit)
+    if i == 0 or i == len(diags):
+        return False
 
-    end_diff = next(i for (i, diff) in enumerate(diffs)
-                    if diff.post_commit == post_commit)
+    before = diags[i-1]
+    after = diags[i+1]
 
-    return diffs[start_diff:end_diff+1]
+    return diag in before.diagnostic_set and diag in after.diagnostic_set
 
 
-def guess_if_compilation_failed(diags, diag, commit):
-    i = next(i for (i, diag) in enumerate(diags)
-             if diag.commit == commit)
+def check_lr_diff(lr_diff: DiagnosticsDiff,
+                  between_commits: List[DiagnosticsFile],
+                  merged_diags: List[DiagnosticsFile],
+                  merged_positions,
+                  hr_lineage: LineageIndex,
+                  hr_timeline: DiffTimeline):
+    "The (missed, zombie) diagnostics of the high res diffs a low res diff spans"
+    missed_diags = []
+    zombie_diags = []
 
-    if diag in diags[i].diagnostics:
-        return False
+    next_lr_commit = hr_timeline.index_of_post(lr_diff.post_commit)
 
-    if i == 0 or i == len(diags):
-        return False
+    # Interesting 1) Diagnostics that appear then disappear entirely between low res commits
+    for between_commit in between_commits:
+        enters = hr_timeline.index_of_post(between_commit.commit)
+        diff = hr_timeline[enters]
 
-    before = diags[i-1]
-    after = diags[i+1]
+        # Count every diagnostic added in diff but leaves but ss_diffs[ss_end]
+        for added_diag in diff.unmatched_new:
+            leaves = hr_lineage.find_when_leaves(
+                added_diag, start=enters, end=next_lr_commit)
+
+            if leaves != next_lr_commit:
+                missed_diags.append({
+                    "diag": added_diag,
+                    "lr_diff": lr_diff,
+                    "enters": hr_timeline[enters].post_commit,
+                    "leaves": hr_timeline[leaves].post_commit
+                })
 
-    return diag in before.diagnostics and diag in after.diagnostics
+    # Interesting 2) Diagnostics that leave and reenter in a high res commit
+    between_start, between_end = hr_timeline.span(lr_diff.pre_commit, lr_diff.post_commit)
+    between_hr_diffs = hr_timeline.diffs[between_start:between_end]
+    print("Between diffs:", between_hr_diffs)
+    for (old, _) in lr_diff.matches.items():
+        leaves = hr_lineage.find_when_leaves(
+            old, start=between_start, end=between_end) - between_start
+        if leaves != len(between_hr_diffs) and not guess_if_compilation_failed(merged_diags, merged_positions, old, between_hr_diffs[leaves].post_commit):
+            zombie_diags.append({
+                "diag": old,
+                "lr_diff": lr_diff,
+                "leaves": between_hr_diffs[leaves]
+            })
+
+    return (missed_diags, zombie_diags)
 
 
 def print_missed_interesting_stuff_2(project: Path,
                                      lr_diags: List[DiagnosticsFile],
                                      hr_diags: List[DiagnosticsFile],
                                      lr_diffs: List[DiagnosticsDiff],
-                                     hr_diffs: List[DiagnosticsDiff]):
+                                     hr_diffs: List[DiagnosticsDiff],
+                                     state: AnalysisState):
     merged_diags = merge_diagnostics(project, lr_diags, hr_diags)
+    merged_positions = {diag.commit: i for (i, diag) in enumerate(merged_diags)}
+    hr_lineage = state.lineage(hr_diffs)
+    lr_timeline = DiffTimeline(lr_diffs)
+    hr_timeline = DiffTimeline(hr_diffs)
 
     missed_diags = []
     zombie_diags = []
 
     for (lr_pre, lr_post) in consecutive_pairs(lr_diags):
-        between_commits = find_commits_between(merged_diags, lr_pre, lr_post)
+        between_commits = find_commits_between(
+            merged_diags, merged_positions, lr_pre, lr_post)
         if len(between_commits) == 0:
             continue
 
-        lr_diff = get_diff(lr_diffs, lr_pre.commit, lr_post.commit)
+        lr_diff = lr_timeline.get(lr_pre.commit, lr_post.commit)
         print("Checking higher resolution commits between", lr_diff)
 
-        next_lr_commit = next(i for (i, diff) in enumerate(hr_diffs)
-                              if diff.post_commit == lr_post.commit)
-
-        # Interesting 1) Diagnostics that appear then disappear entirely between low res commits
-        for between_commit in between_commits:
-            (enters, diff) = next((i, diff) for (i, diff) in enumerate(hr_diffs)
-                                  if diff.post_commit == between_commit.commit)
-
-            # Count every diagnostic added in diff but leaves but ss_diffs[ss_end]
-            for added_diag in diff.unmatched_new:
-                leaves = find_when_leaves(
-                    hr_diffs, added_diag, start=enters, end=next_lr_commit)
-
-                if leaves != next_lr_commit:
-                    missed_diags.append({
-                        "diag": added_diag,
-                        "lr_diff": lr_diff,
-                        "enters": hr_diffs[enters].post_commit,
-                        "leaves": hr_diffs[leaves].post_commit
-                    })
-
-        # Interesting 2) Diagnostics that leave and reenter in a high res commit
-        between_hr_diffs = get_diffs(hr_diffs, lr_pre.commit, lr_post.commit)
-        print("Between diffs:", between_hr_diffs)
-        for (old, _) in lr_diff.matches.items():
-            leaves = find_when_leaves(between_hr_diffs, old)
-            if leaves != len(between_hr_diffs) and not guess_if_compilation_failed(merged_diags, old, between_hr_diffs[leaves].post_commit):
-                zombie_diags.append({
-                    "diag": old,
-                    "lr_diff": lr_diff,
-                    "leaves": between_hr_diffs[leaves]
-                })
+        # Everything a low res diff's findings are worked out from, down to
+        # the commits either side used to guess at failed compilations
+        i1 = merged_positions[lr_pre.commit]
+        i2 = merged_positions[lr_post.commit]
+        inputs = [lr_diff.file,
+                  *(diff.file for diff in hr_timeline.between(lr_pre.commit, lr_post.commit)),
+                  *(diag.file for diag in merged_diags[i1:i2+2])]
+
+        (missed, zombies) = state.memo((lr_pre.commit, lr_post.commit), inputs,
+                                       lambda: check_lr_diff(lr_diff, between_commits, merged_diags,
+                                                             merged_positions, hr_lineage, hr_timeline))
+        missed_diags.extend(missed)
+        zombie_diags.extend(zombies)
+
+    state.save()
+    print(state)
 
     print()
     print("---------------")
@@ -156,11 +178,13 @@ if __name__ == "__main__":
 
     print("Loading comparisons")
     lr_comparisons = DiagnosticsDiff.load_all(Path(sys.argv[4]))
-    hr_comparisons = DiagnosticsDiff.load_all(Path(sys.argv[5]))
+    hr_folder = Path(sys.argv[5])
+    hr_comparisons = DiagnosticsDiff.load_all(hr_folder)
 
     print_missed_interesting_stuff_2(
         project,
         lowres_diags,
         highres_diags,
         lr_comparisons,
-        hr_comparisons)
+        hr_comparisons,
+        AnalysisState(hr_folder, "missed_diagnostics"))
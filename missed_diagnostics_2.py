@@ -2,7 +2,8 @@
 
 import sys
 
-from diag_utils import DiagnosticsFile, DiagnosticsDiff, Diagnostic, find_when_leaves
+from analysis_state import AnalysisState
+from diag_utils import DiagnosticsFile, DiagnosticsDiff, Diagnostic, DiffTimeline, LineageIndex
 from pathlib import Path
 
 
@@ -11,7 +12,7 @@ def load_files(folder):
         return tuple([int(s) for s in filename.suffix[1:].split("-")])
 
     loaded_files = [
-        (extract_grains(file), DiagnosticsFile.load(file))
+        (extract_grains(file), DiagnosticsFile.stream(file))
         for file in folder.glob("*")
         if file.is_file()
     ]
@@ -38,44 +39,50 @@ def find_missed_commits(grains_and_files):
             missing_subsequence.append(file)
 
 
-def get_diff(diffs, pre_commit, post_commit):
-    return next((diff for diff in diffs
-                 if diff.pre_commit == pre_commit and diff.post_commit == post_commit))
+def check_missed_commits(missed_commits, lineage: LineageIndex, timeline: DiffTimeline):
+    "Diagnostics added and gone again between the scanned commits either end of missed_commits"
+    between_start, between_end = timeline.span(
+        missed_commits[0].commit, missed_commits[-1].commit)
+    between_diffs = timeline.diffs[between_start:between_end]
 
+    missed_diags = []
+    for (i, between_diff) in enumerate(between_diffs[:-1]):
+        for added_diag in between_diff.unmatched_new:
+            leaves = lineage.find_when_leaves(
+                added_diag, start=between_start+i, end=between_end) - between_start
 
-def get_diffs(diffs, pre_commit, post_commit):
-    start_diff = next(i for (i, diff) in enumerate(diffs)
-                      if diff.pre_commit == pre_commit)
+            # If diagnostic doesn't leave after next scanned commit
+            if leaves != len(between_diffs):
+                missed_diags.append({
+                    "diag": added_diag,
+                    "start_commit": f"{missed_commits[0].seq}  {missed_commits[0].commit}",
+                    "end_commit": f"{missed_commits[-1].seq}  {missed_commits[-1].commit}",
+                    "enters": f"{between_diff.post} {between_diff.post_commit}",
+                    "leaves": f"{between_diffs[leaves].post} {between_diffs[leaves].post_commit}"
+                })
 
-    end_diff = next(i for (i, diff) in enumerate(diffs)
-                    if diff.post_commit == post_commit)
+    return missed_diags
 
-    return diffs[start_diff:end_diff+1]
 
 if __name__ == "__main__":
     grains_and_files = load_files(Path(sys.argv[1]))
-    diffs = DiagnosticsDiff.load_all(Path(sys.argv[2]))
+    diffs_folder = Path(sys.argv[2])
+    diffs = DiagnosticsDiff.load_all(diffs_folder)
+    state = AnalysisState(diffs_folder, "missed_diagnostics_2")
+    lineage = state.lineage(diffs)
+    timeline = DiffTimeline(diffs)
 
     missed_diags = []
 
     for missed_commits in find_missed_commits(grains_and_files):
-        between_diffs = get_diffs(
-            diffs, missed_commits[0].commit, missed_commits[-1].commit)
-
-        # Look for missed diagnostics
-        for (i, between_diff) in enumerate(between_diffs[:-1]):
-            for added_diag in between_diff.unmatched_new:
-                leaves = find_when_leaves(between_diffs, added_diag, start=i)
-
-                # If diagnostic doesn't leave after next scanned commit
-                if leaves != len(between_diffs):
-                    missed_diags.append({
-                        "diag": added_diag,
-                        "start_commit": f"{missed_commits[0].seq}  {missed_commits[0].commit}",
-                        "end_commit": f"{missed_commits[-1].seq}  {missed_commits[-1].commit}",
-                        "enters": f"{between_diff.post} {between_diff.post_commit}",
-                        "leaves": f"{between_diffs[leaves].post} {between_diffs[leaves].post_commit}"
-                    })
+        inputs = [*(file.file for file in missed_commits),
+                  *(diff.file for diff in timeline.between(missed_commits[0].commit, missed_commits[-1].commit))]
+
+        missed_diags.extend(state.memo(tuple(file.commit for file in missed_commits), inputs,
+                                       lambda: check_missed_commits(missed_commits, lineage, timeline)))
+
+    state.save()
+    print(state)
 
     print()
     print("---------------")
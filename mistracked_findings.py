@@ -1,65 +1,175 @@
 #!/bin/python3
+import json
+import multiprocessing
 import sys
+import time
 
-from diag_utils import DiagnosticsDiff, Diagnostic, find_when_leaves
+from diag_utils import DiagnosticsDiff, Diagnostic, DiffTimeline, LineageIndex
 from pathlib import Path
 from missed_diagnostics_2 import find_missed_commits
 
 Trackers = ["character_line_tracker", "token_line_tracker", "ijm_pos_tracker", "ijm_start_and_end", "ijm_joint"]
 
-def find_between_diffs(interleaved_diffs, lowres_diffs):
-    assert len(lowres_diffs) <= len(interleaved_diffs) 
 
-    il_i = 0
-    for lr_diff in lowres_diffs:
-        il_diff = interleaved_diffs[il_i]
-
-        if il_diff.post_commit != lr_diff.post_commit:
-            ir_missing_region = []
-
-            while interleaved_diffs[il_i].post_commit != lr_diff.post_commit:
-                ir_missing_region.append(interleaved_diffs[il_i])
-                il_i += 1
-
-            ir_missing_region.append(interleaved_diffs[il_i])
+def tracker_folders(comparisons_folder: Path, project: str, tracker: str):
+    "The interleaved and low res comparison folders of a tracker"
+    return (comparisons_folder / (project + "_" + tracker),
+            comparisons_folder / (project + "_" + tracker + "_lowres"))
 
-            yield (lr_diff, ir_missing_region)
 
-        assert lr_diff.post_commit == lr_diff.post_commit
+def find_boundaries(interleaved_diffs: DiffTimeline, lowres_diffs):
+    "(low res index, start, end) of each low res diff spanning several interleaved diffs"
+    assert len(lowres_diffs) <= len(interleaved_diffs)
 
-        il_i += 1
+    boundaries = []
+    il_i = 0
+    for (lr_i, lr_diff) in enumerate(lowres_diffs):
+        il_end = interleaved_diffs.index_of_post(lr_diff.post_commit)
+
+        if il_end != il_i:
+            boundaries.append((lr_i, il_i, il_end+1))
+
+        il_i = il_end + 1
+
+    return boundaries
+
+
+def find_between_diffs(interleaved_diffs: DiffTimeline, lowres_diffs, boundaries=None):
+    "Yields each low res diff spanning several interleaved diffs with where they start"
+    if boundaries is None:
+        boundaries = find_boundaries(interleaved_diffs, lowres_diffs)
+
+    for (lr_i, start, end) in boundaries:
+        yield (lowres_diffs[lr_i], start, interleaved_diffs.diffs[start:end])
+
+
+def check_tracker(interleaved_comparisons, low_res_comparisons, boundaries=None):
+    """
+    Yields (low res diff, mistracked, not tracked) for every low res diff
+    spanning several interleaved diffs. mistracked are the (old, new, diff it
+    was lost in) of matches the interleaved diffs don't track the whole way,
+    and not tracked the unmatched old diagnostics they do.
+    """
+    lineage = LineageIndex(interleaved_comparisons)
+
+    def find_when_leaves(between_start, between_diffs, diag):
+        return lineage.find_when_leaves(diag,
+                                        start=between_start,
+                                        end=between_start+len(between_diffs)) - between_start
+
+    for (lr_diff, between_start, between_diffs) in find_between_diffs(DiffTimeline(interleaved_comparisons), low_res_comparisons, boundaries):
+        mistracked = []
+        for (old, new) in lr_diff.matches.items():
+            leaves = find_when_leaves(between_start, between_diffs, old)
+            if leaves != len(between_diffs):
+                mistracked.append((old, new, between_diffs[leaves]))
+
+        not_tracked = []
+        already_unmatched = between_diffs[0].unmatched_old_set.contains(lr_diff.unmatched_old_set)
+        for (unmatched_diag, skip) in zip(lr_diff.unmatched_old, already_unmatched):
+            if skip:
+                continue
+
+            leaves = find_when_leaves(between_start, between_diffs, unmatched_diag)
+            if leaves == len(between_diffs):
+                not_tracked.append(unmatched_diag)
+
+        yield (lr_diff, mistracked, not_tracked)
+
+
+def _evaluate_tracker(job):
+    (comparisons_folder, project, tracker, commits, boundaries) = job
+    start = time.time()
+
+    (interleaved_folder, low_res_folder) = tracker_folders(comparisons_folder, project, tracker)
+    interleaved_comparisons = DiagnosticsDiff.load_all(interleaved_folder)
+    low_res_comparisons = DiagnosticsDiff.load_all(low_res_folder)
+
+    # The shared boundaries only hold if this tracker compared the same commits
+    if [diff.post_commit for diff in interleaved_comparisons] != commits[0] or \
+            [diff.post_commit for diff in low_res_comparisons] != commits[1]:
+        boundaries = None
+
+    mistracked_findings = []
+    not_tracked_findings = []
+    low_res_diffs = 0
+    for (lr_diff, mistracked, not_tracked) in check_tracker(interleaved_comparisons, low_res_comparisons, boundaries):
+        low_res_diffs += 1
+        mistracked_findings.extend({"lr_diff": str(lr_diff), "old": str(old), "new": str(new), "lost_in": str(lost_in)}
+                                   for (old, new, lost_in) in mistracked)
+        not_tracked_findings.extend({"lr_diff": str(lr_diff), "diag": str(diag)}
+                                    for diag in not_tracked)
+
+    return {
+        "tracker": tracker,
+        "low_res_diffs": low_res_diffs,
+        "mistracked": len(mistracked_findings),
+        "not_tracked": len(not_tracked_findings),
+        "seconds": round(time.time() - start, 3),
+        "mistracked_findings": mistracked_findings,
+        "not_tracked_findings": not_tracked_findings,
+    }
+
+
+def evaluate_all_trackers(project: str, comparisons_folder: Path, report: Path):
+    "Checks every tracker at once, one process each, and writes a JSON report comparing them"
+    trackers = [tracker for tracker in Trackers
+                if all(folder.is_dir() for folder in tracker_folders(comparisons_folder, project, tracker))]
+    if len(trackers) == 0:
+        raise Exception("no tracker comparisons for " + project)
+
+    # Diffs are only read when their contents are asked for, so this is just the filenames
+    start = time.time()
+    (interleaved_folder, low_res_folder) = tracker_folders(comparisons_folder, project, trackers[0])
+    interleaved_comparisons = DiagnosticsDiff.load_all(interleaved_folder)
+    low_res_comparisons = DiagnosticsDiff.load_all(low_res_folder)
+    commits = ([diff.post_commit for diff in interleaved_comparisons],
+               [diff.post_commit for diff in low_res_comparisons])
+    boundaries = find_boundaries(DiffTimeline(interleaved_comparisons), low_res_comparisons)
+
+    with multiprocessing.Pool(len(trackers)) as pool:
+        results = pool.map(_evaluate_tracker, [(comparisons_folder, project, tracker, commits, boundaries)
+                                               for tracker in trackers])
+
+    with open(report, "w") as f:
+        json.dump({
+            "project": project,
+            "seconds": round(time.time() - start, 3),
+            "trackers": {result["tracker"]: result for result in results}
+        }, f, indent=2)
+
+    for result in results:
+        print(f"{result['tracker']:<24} {result['mistracked']:>6} mistracked "
+              f"{result['not_tracked']:>6} not tracked in {result['seconds']:.1f}s")
+    print("Wrote", report)
 
 
 if __name__ == "__main__":
     project = sys.argv[1]
     comparisons_folder = Path(sys.argv[2])
 
+    if "--all" in sys.argv:
+        evaluate_all_trackers(project, comparisons_folder, Path(sys.argv[sys.argv.index("--all")+1]))
+        sys.exit(0)
+
+    workers = int(sys.argv[3]) if len(sys.argv) == 4 else None
+
     for tracker in Trackers:
         print("Checking", tracker)
-        interleaved_comparisons = DiagnosticsDiff.load_all(
-            comparisons_folder / (project + "_" + tracker))
+        (interleaved_folder, low_res_folder) = tracker_folders(comparisons_folder, project, tracker)
+        interleaved_comparisons = DiagnosticsDiff.load_all(interleaved_folder, workers=workers)
+        low_res_comparisons = DiagnosticsDiff.load_all(low_res_folder, workers=workers)
 
-        low_res_comparisons = DiagnosticsDiff.load_all(
-            comparisons_folder / (project + "_" + tracker + "_lowres"))
-
-        for (lr_diff, between_diffs) in find_between_diffs(interleaved_comparisons, low_res_comparisons):
+        for (lr_diff, mistracked, not_tracked) in check_tracker(interleaved_comparisons, low_res_comparisons):
             print("Checking low res diff", lr_diff)
-            for (old, new) in lr_diff.matches.items():
-                leaves = find_when_leaves(between_diffs, old) 
-                if leaves != len(between_diffs):
-                    print(f"Mistracked finding in {lr_diff}")
-                    print(old)
-                    print(" to ")
-                    print(new)
-                    print(f"  But was not tracked over {between_diffs[leaves]}")
-                    print()
-
-            for unmatched_diag in lr_diff.unmatched_old:
-                if unmatched_diag in between_diffs[0].unmatched_old:
-                    continue
-
-                leaves = find_when_leaves(between_diffs, unmatched_diag)
-                if leaves == len(between_diffs):
-                    print(f"Finding not tracked over {lr_diff} but was tracked through induviduals")
-                    print(unmatched_diag)
-
+            for (old, new, lost_in) in mistracked:
+                print(f"Mistracked finding in {lr_diff}")
+                print(old)
+                print(" to ")
+                print(new)
+                print(f"  But was not tracked over {lost_in}")
+                print()
+
+            for unmatched_diag in not_tracked:
+                print(f"Finding not tracked over {lr_diff} but was tracked through induviduals")
+                print(unmatched_diag)
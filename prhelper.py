@@ -6,6 +6,7 @@ from diag_utils import Diagnostic, DiagnosticsDiff
 from pathlib import Path
 from meyersdiff import *
 from matchhelper2 import FileLoader
+from diff_cache import load_hunks, load_line_map
 
 from itertools import chain
 
@@ -103,21 +104,7 @@ class Window(tk.Frame):
 
 
 def find_closest_line(text, index, new_text):
-    diffs = myers_diff(text, new_text)
-
-    line = 0
-    new_line = 0
-    for diff in diffs:
-        if isinstance(diff, Keep):
-            line += 1
-            new_line += 1
-        elif isinstance(diff, Insert):
-            new_line += 1
-        elif isinstance(diff, Remove):
-            line += 1
-
-        if line == index:
-            return new_line
+    return load_line_map(text, new_text).closest_new_line(index)
 
 
 def set_line_col(text, line, col):
@@ -126,24 +113,14 @@ def set_line_col(text, line, col):
     text.tag_config(tag, foreground=col)
 
 
-def add_diff_highlighting(e_old, e_new, diffs):
-    # Highlight left hand side
-    line = 1
-
-    for diff in diffs:
-        if isinstance(diff, Insert):
-            continue
-        if isinstance(diff, Remove):
-            set_line_col(e_old, line, "red")
-        line += 1
-
-    line = 1
-    for diff in diffs:
-        if isinstance(diff, Remove):
-            continue
-        if isinstance(diff, Insert):
-            set_line_col(e_new, line, "green")
-        line += 1
+def add_diff_highlighting(e_old, e_new, hunks):
+    for hunk in hunks:
+        if hunk.op == REMOVE:
+            for line in range(hunk.old_start + 1, hunk.old_end + 1):
+                set_line_col(e_old, line, "red")
+        elif hunk.op == INSERT:
+            for line in range(hunk.new_start + 1, hunk.new_end + 1):
+                set_line_col(e_new, line, "green")
 
 
 def convert_pos_to_line_col(lines, position):
@@ -198,7 +175,8 @@ def ask_question(old_src: str, new_src: str, **kwargs):
     new_src_tk.geometry("%dx%d+%d+%d" % (ws/2 - 20, 1080-250+5, (ws/2), 200))
     windows.append(new_src_tk)
 
-    add_diff_highlighting(e_old.text, e_new.text, myers_diff(old_src, new_src))
+    hunks = load_hunks(old_src, new_src)
+    add_diff_highlighting(e_old.text, e_new.text, hunks)
 
     old_in = "old_diag" in kwargs
     new_in = "new_diag" in kwargs
@@ -232,8 +210,8 @@ def ask_question(old_src: str, new_src: str, **kwargs):
         set_line(e_new, kwargs["new_diag"]._line)
     elif old_in:
         set_line(e_old, kwargs["old_diag"]._line)
-        set_line(e_new, find_closest_line(
-            old_src, kwargs["old_diag"]._line, new_src))
+        set_line(e_new, LineMap(hunks).closest_new_line(
+            kwargs["old_diag"]._line))
     else:
         set_line(e_old, find_closest_line(
             new_src, kwargs["new_diag"]._line, old_src))
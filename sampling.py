@@ -0,0 +1,105 @@
+import random
+
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from diag_utils import Diagnostic
+
+# What a sample can be stratified by, given the diagnostic an item is about
+STRATA: Dict[str, Callable[[Diagnostic], Hashable]] = {
+    "type": lambda diag: diag._type,
+    "file": lambda diag: diag._file,
+}
+
+
+def stratify_by(by: Optional[str], diagnostic_of: Callable = lambda item: item) -> Optional[Callable]:
+    "A StratifiedReservoir key splitting items by one of STRATA, or None to not split them"
+    if by is None:
+        return None
+
+    stratum = STRATA[by]
+    return lambda item: stratum(diagnostic_of(item))
+
+
+class StratifiedReservoir:
+    """
+    A uniform random sample of a stream of items without holding the stream.
+    Each stratum keeps a reservoir of up to k items (Algorithm R) and the
+    sample is split across strata in proportion to how many items of each
+    were seen, so nothing has to be counted up front. The same items in the
+    same order with the same seed always give the same sample.
+
+    That costs O(min(n, k * strata)) memory for n items, not O(k): until the
+    stream ends any stratum could turn out to be most of it and need all k,
+    so with many small strata (--by file) it can hold far more than k items.
+    """
+
+    def __init__(self, k: int, key: Callable = None, seed=None):
+        self.k = k
+        self.seen = 0
+        self._key = key
+        self._rng = random.Random(seed)
+        self._reservoirs: Dict[Hashable, list] = {}
+        self._seen: Dict[Hashable, int] = {}
+
+    def add(self, item):
+        stratum = None if self._key is None else self._key(item)
+        reservoir = self._reservoirs.setdefault(stratum, [])
+        seen = self._seen.get(stratum, 0) + 1
+        self._seen[stratum] = seen
+        self.seen += 1
+
+        if len(reservoir) < self.k:
+            reservoir.append(item)
+        else:
+            i = self._rng.randrange(seen)
+            if i < self.k:
+                reservoir[i] = item
+
+    def extend(self, items: Iterable):
+        for item in items:
+            self.add(item)
+
+    def allocation(self, n: int) -> Dict[Hashable, int]:
+        "How many of n items each stratum gives, largest remainders first then in the order seen"
+        allocation = {stratum: n * seen // self.seen for (stratum, seen) in self._seen.items()}
+        remainders = sorted(self._seen, key=lambda stratum: -(n * self._seen[stratum] % self.seen))
+        for stratum in remainders[:n - sum(allocation.values())]:
+            allocation[stratum] += 1
+
+        return allocation
+
+    def sample(self, n: int = None) -> List:
+        """
+        Draws n of the items seen, as many as the reservoirs hold by default.
+        n can't be more than k, but a k larger than needed is fine as a random
+        part of a uniform sample is itself a uniform sample.
+        """
+        n = min(self.k if n is None else n, self.k, self.seen)
+        if n == 0:
+            return []
+
+        allocation = self.allocation(n)
+        return [item
+                for (stratum, reservoir) in self._reservoirs.items()
+                for item in self._rng.sample(reservoir, allocation[stratum])]
+
+
+def pop_options(argv: List[str]) -> Tuple[List[str], Optional[int], Optional[str]]:
+    "Takes --seed <n> and --by <type|file> out of argv, returning what's left, the seed and stratum"
+    argv = list(argv)
+    seed = None
+    by = None
+
+    if "--seed" in argv:
+        i = argv.index("--seed")
+        seed = int(argv[i+1])
+        del argv[i:i+2]
+
+    if "--by" in argv:
+        i = argv.index("--by")
+        by = argv[i+1]
+        del argv[i:i+2]
+        if by not in STRATA:
+            raise Exception(by + " is not one of " + ", ".join(STRATA))
+
+    return (argv, seed, by)
@@ -2,10 +2,10 @@
 
 import sys
 import githelpers
+import java_formatter
 import os
 import multiprocess as mp
 import shutil
-import subprocess
 
 from pathlib import Path
 from diag_utils import DiagnosticsFile
@@ -45,8 +45,7 @@ if __name__ == "__main__":
             p.parents[0].mkdir(parents=True, exist_ok=True)
             open(p, "w").write(src)
 
-        subprocess.run(["java", "-jar", "google-format.jar", "-i",
-                        "--skip-sorting-imports", "--skip-removing-unused-imports", *files_to_format])
+        java_formatter.format_files(files_to_format)
 
         # Format files
         new_commit = githelpers.commit_all(new_repo)
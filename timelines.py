@@ -5,7 +5,8 @@ import sys
 
 from pathlib import Path
 
-from diag_utils import Diagnostic, DiagnosticsDiff, find_when_leaves
+from analysis_state import AnalysisState
+from diag_utils import Diagnostic, DiagnosticsDiff
 
 
 SCALE_FACTOR = 1
@@ -15,90 +16,146 @@ def recover_original_diagnostics(file: DiagnosticsDiff):
     return [*file.unmatched_old, *file.matches.keys()]
 
 
-def diag_lifetime(diag_and_lifetime):
-    (_, (enter, leave)) = diag_and_lifetime
-    return leave-enter
-
-
-def scale(factor, d):
-    result = []
-    for i in d:
-        result.extend((i for _ in range(factor)))
-    return result
-
-
-def gen_pixel_row(enter, leave, total):
-    def pixel(i):
-        if enter <= i <= leave:
-            return 0  # black for yes
-        else:
-            return 1  # white for no
-
-    return scale(SCALE_FACTOR, [pixel(i) for i in range(1, total+1)])
-
-
-def generate_image_plot(commit_and_diag_info):
-    result = []
-    for diag_and_lifetimes in commit_and_diag_info:
-        if len(diag_and_lifetimes) == 0:
-            continue
-
-        diag_and_lifetimes = sorted(diag_and_lifetimes,
-                                    reverse=True,
-                                    key=diag_lifetime)
-
-        for (_, (enter, leave)) in diag_and_lifetimes:
-            result.append(gen_pixel_row(
-                enter+1, leave+1, len(commit_and_diag_info)-1))
-
-    return result
+def lifetime_order(enters: np.ndarray, leaves: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    "Rows ordered by group, then longest lived first"
+    # lexsort is stable and sorts by its last key first
+    return np.lexsort((-(leaves - enters), groups))
+
+
+def lifetime_matrix(enters: np.ndarray, leaves: np.ndarray, groups: np.ndarray, total: int) -> np.ndarray:
+    """
+    One row per diagnostic, black (0) for the commits 1..total it is alive in
+    and white (1) elsewhere. Rows are ordered by group, then longest lived first.
+    """
+    order = lifetime_order(enters, leaves, groups)
+
+    commits = np.arange(1, total+1)
+    alive = ((enters[order, None] + 1) <= commits) & (commits <= (leaves[order, None] + 1))
+
+    return np.repeat((~alive).astype(np.uint8), SCALE_FACTOR, axis=1)
+
+
+def downsampled_lifetimes(enters: np.ndarray, leaves: np.ndarray, groups: np.ndarray, total: int,
+                          max_rows: int, max_cols: int) -> np.ndarray:
+    """
+    lifetime_matrix with blocks of pixels averaged so it fits in max_rows x
+    max_cols, worked out from where each row's black run starts and ends
+    rather than from the matrix, which can be far too large to hold.
+    """
+    (rows, cols) = (len(enters), total * SCALE_FACTOR)
+    row_step = max(1, -(-rows // max_rows))
+    col_step = max(1, -(-cols // max_cols))
+    num_blocks = -(-rows // row_step)
+    num_buckets = -(-cols // col_step)
+
+    # Each row is black over the columns [start, end), in blocks of row_step rows
+    order = lifetime_order(enters, leaves, groups)
+    start = np.clip(enters[order], 0, total) * SCALE_FACTOR
+    end = np.clip(leaves[order] + 1, 0, total) * SCALE_FACTOR
+    block = np.arange(rows) // row_step
+    runs = start < end
+    (start, end, block) = (start[runs], end[runs], block[runs])
+
+    # The buckets of col_step columns a run starts and ends in get what part of
+    # it falls in them, and every bucket between all col_step columns, added
+    # as +col_step / -col_step and summed along the row of blocks
+    first = start // col_step
+    last = (end - 1) // col_step
+    single = first == last
+
+    black = np.zeros((num_blocks, num_buckets), dtype=np.int64)
+    (many, many_first, many_last) = (block[~single], first[~single], last[~single])
+    np.add.at(black, (many, many_first + 1), col_step)
+    np.add.at(black, (many, many_last), -col_step)
+    black = np.cumsum(black, axis=1)
+
+    np.add.at(black, (block[single], first[single]), end[single] - start[single])
+    np.add.at(black, (many, many_first), (many_first + 1) * col_step - start[~single])
+    np.add.at(black, (many, many_last), end[~single] - many_last * col_step)
+
+    # Blocks running past the edges are padded with white
+    return 1 - black / (row_step * col_step)
+
+
+def finish_plot(out: Path = None):
+    "Shows the plot, or writes it to out without needing a display"
+    if out is None:
+        plt.show()
+    else:
+        plt.savefig(out, dpi=200, bbox_inches="tight")
+        print("Wrote", out)
 
 
-def show_image(bitmask):
-    num_of_commits = len(bitmask[0]) / SCALE_FACTOR
+def show_image(bitmask: np.ndarray, rows: int, cols: int, out: Path = None):
+    "Shows bitmask as a rows x cols lifetime matrix, which it may be a downsampled one of"
+    num_of_commits = cols / SCALE_FACTOR
 
     plt.title(
         f"Induvidual diagnostics tracked over {num_of_commits} commits", fontsize=18)
-    plt.xticks(np.arange(1, len(bitmask[0])+2, SCALE_FACTOR), rotation=90)
+    if num_of_commits <= 100:
+        plt.xticks(np.arange(1, cols+2, SCALE_FACTOR), rotation=90)
     plt.xlabel("Commit", fontsize=15)
     plt.ylabel("Diagnostic", fontsize=15)
-    plt.pcolormesh(bitmask, cmap=plt.cm.gray)
+    # Laid out over the same coordinates pcolormesh would use, whatever the downsampling
+    plt.imshow(bitmask, cmap=plt.cm.gray, vmin=0, vmax=1, origin="lower",
+               extent=(0, cols, 0, rows), aspect="auto", interpolation="nearest")
 
-    plt.show()
+    finish_plot(out)
 
 
-def gen_diag_timeline(project: Path):
+def gen_diag_timeline(project: Path, out: Path = None, max_size: int = None):
     if not project.exists():
         raise Exception(project + " is not a folder")
 
     print("Generating for project " + project.stem)
     all_diffs = DiagnosticsDiff.load_all(project)
+    state = AnalysisState(project, "timelines")
+    lineage = state.lineage(all_diffs)
 
-    starting_diags = recover_original_diagnostics(all_diffs[0])
     max_commit = max(diff.post for diff in all_diffs)
 
+    # Remember the tracks each diff starts rather than where they leave, which
+    # changes as diffs are appended, so only new diffs need reading
+    def added_tracks(i, diff):
+        return [lineage.track_from(added_diag, start=i+1) for added_diag in diff.unmatched_new]
+
     # Find where all the starting diagnostics leave
-    commit_and_diag_info = [[] for _ in range(max_commit)]
-    for diag in starting_diags:
-        commit_and_diag_info[0].append(
-            (diag, (0, find_when_leaves(all_diffs, diag))))
+    starting_tracks = state.memo(("starting", state.generation), [all_diffs[0].file],
+                                 lambda: [lineage.track_from(diag)
+                                          for diag in recover_original_diagnostics(all_diffs[0])])
+    enters = [0] * len(starting_tracks)
+    leaves = [lineage.leaves(track) for track in starting_tracks]
+    groups = [0] * len(starting_tracks)
 
     # Find when any diffs added in the future leaves
     for (i, diff) in enumerate(all_diffs):
-        for added_diag in diff.unmatched_new:
-            leaves = find_when_leaves(all_diffs, added_diag, start=i+1)
-            commit_and_diag_info[diff.pre].append((added_diag, (i, leaves)))
-
-    bitmask = generate_image_plot(commit_and_diag_info)
+        tracks = state.memo(("added", state.generation, diff.file.name), [diff.file],
+                            lambda: added_tracks(i, diff))
+        enters.extend([i] * len(tracks))
+        leaves.extend(lineage.leaves(track) for track in tracks)
+        groups.extend([diff.pre] * len(tracks))
+
+    state.save()
+    print(state)
+
+    enters = np.array(enters, dtype=np.int64)
+    leaves = np.array(leaves, dtype=np.int64)
+    groups = np.array(groups, dtype=np.int64)
+    total = max_commit-1
+
+    if max_size is None:
+        bitmask = lifetime_matrix(enters, leaves, groups, total)
+    else:
+        bitmask = downsampled_lifetimes(enters, leaves, groups, total, max_size, max_size)
 
-    show_image(bitmask)
+    show_image(bitmask, len(enters), total * SCALE_FACTOR, out)
 
 
-def gen_total_timeline(proj: Path):
+def gen_total_timeline(proj: Path, out: Path = None):
     all_diffs = DiagnosticsDiff.load_all(proj)
 
     labels = [i for i in range(1, len(all_diffs)+1)]
-    number_of_diags_in_commit = [len(diff.matches.values()) + len(diff.unmatched_new)
+    number_of_diags_in_commit = [diff.num_matches + diff.num_unmatched_new
                                  for diff in all_diffs]
     x_pos = [i for i, _ in enumerate(labels)]
 
@@ -109,16 +166,25 @@ def gen_total_timeline(proj: Path):
 
     plt.xticks(x_pos, labels)
 
-    plt.show()
+    finish_plot(out)
 
 
 if __name__ == "__main__":
     cmd = sys.argv[1]
     proj = Path(sys.argv[2])
 
+    # --png <file> writes the plot instead of showing it, --max-size <pixels>
+    # averages blocks of the diagnostics timeline down to at most that size
+    options = sys.argv[3:]
+    out = Path(options[options.index("--png")+1]) if "--png" in options else None
+    max_size = int(options[options.index("--max-size")+1]) if "--max-size" in options else None
+
+    if out is not None:
+        plt.switch_backend("agg")
+
     if cmd == "diagnostics":
-        gen_diag_timeline(proj)
+        gen_diag_timeline(proj, out, max_size)
     elif cmd == "totals":
-        gen_total_timeline(proj)
+        gen_total_timeline(proj, out)
     else:
         raise Exception("Unrecognised command " + cmd)